@@ -0,0 +1,50 @@
+# Reading the ABBYY FineReader XML files that archive.org produces.
+
+import gzip
+from ocr_xml import iterparse_elements
+
+
+ABBYY_SCHEMA = 'http://www.abbyy.com/FineReader_xml/FineReader10-schema-v1.xml'
+
+PAGE_TAG = '{%s}page' % ABBYY_SCHEMA
+BLOCK_TAG = '{%s}block' % ABBYY_SCHEMA
+
+
+def open_abbyy(path):
+    '''open_abbyy opens an ABBYY XML file for reading, decompressing it
+    if it is gzipped.'''
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def iter_pages(path, keep=None):
+    '''iter_pages parses the ABBYY file at path, which may be gzipped,
+    incrementally, yielding the index and element of each page element
+    in turn.  Each page is discarded once the caller is done with it so
+    memory use doesn't grow with the length of the book.  keep is as
+    for ocr_xml.iterparse_elements.'''
+    with open_abbyy(path) as f:
+        for index, elt in enumerate(iterparse_elements(f, PAGE_TAG, keep)):
+            yield index, elt
+
+
+def iter_page_blocks(path):
+    '''iter_page_blocks is like iter_pages except that the block
+    elements, without their contents, are all that is retained within
+    each page.'''
+    return iter_pages(path, keep=(BLOCK_TAG,))
+
+
+def picture_blocks(page_elt):
+    '''picture_blocks returns the block elements of page_elt that ABBYY
+    identified as pictures.'''
+    return [block for block in page_elt.iter(BLOCK_TAG)
+            if block.attrib.get('blockType') == 'Picture']
+
+
+def picture_page_indexes(path):
+    '''picture_page_indexes returns the (0 based) indexes of the pages
+    of the ABBYY file at path that have at least one picture block.'''
+    return [index for index, page_elt in iter_page_blocks(path)
+            if len(picture_blocks(page_elt)) > 0]
@@ -2,7 +2,14 @@
 
 # Code to interact with archive.org.
 
+import codecs
+import hashlib
+import http.client
 import json
+import os
+import threading
+import time
+import urllib.error
 import urllib.request
 import zipfile
 
@@ -15,24 +22,248 @@ METADATA_URL_TEMPLATE = 'https://archive.org/metadata/{NAME}'
 # and name from the archived documents metadata.
 FILE_FETCH_URL_TEMPLATE = 'https://archive.org{DIR}/{NAME}'
 
-def fetch_url_to_file(url, filename, binary=False):
+# Downloads are streamed in chunks of this many bytes so that large
+# archives are never held in memory.
+CHUNK_SIZE = 1 << 20
+
+
+class ChecksumError (Exception):
+    '''ChecksumError is raised when a downloaded file doesn't match the
+    size or hashes recorded in its item's metadata.'''
+    pass
+
+
+def open_url(url, headers=None):
+    '''open_url is the default opener for fetch_url_to_file.  It opens a
+    new connection for each call.  See downloader.HostConnections for
+    one that reuses connections.'''
+    return urllib.request.urlopen(urllib.request.Request(url, headers=headers or {}))
+
+
+def hash_file(filename, hashers):
+    '''hash_file updates each of hashers with the contents of filename.'''
+    with open(filename, 'rb') as f:
+        while True:
+            buffer = f.read(CHUNK_SIZE)
+            if len(buffer) == 0:
+                break
+            for h in hashers:
+                h.update(buffer)
+
+
+def fetch_url_to_file(url, filename, binary=False, opener=open_url,
+                      file_metadata=None, tee=None):
+    '''fetch_url_to_file streams the content of url to filename.
+    opener is called with the url and any request headers to get a
+    response.
+
+    The content is first written to filename + '.part', which is only
+    renamed to filename once it is complete.  If a .part file is left
+    from an interrupted transfer, an HTTP Range request is used to
+    fetch only the remainder.
+
+    If file_metadata, the file's entry from its item's metadata, is
+    specified then the size and any md5 and sha1 hashes it records are
+    checked as the data streams in.  ChecksumError is raised if they
+    don't match.
+
+    If tee is specified it is called with each chunk of data as it is
+    written.  It isn't called for data fetched by an earlier, interrupted
+    transfer.'''
     print("Fetching", url)
-    with urllib.request.urlopen(url) as input:
-        with open(filename, 'wb' if binary else 'w') as out:
-            if binary:
-                out.write(input.read())
-            else:
-                info = input.info()
-                charset = info.get_content_charset()   # info['Content-Type'].params['charset']
-                out.write(input.read().decode(charset, 'replace'))
-
-def fetch_metadata(name):
-    uri = METADATA_URL_TEMPLATE.format(NAME=name)
-    with urllib.request.urlopen(uri) as input:
+    part = filename + '.part'
+    offset = 0
+    if os.path.exists(part):
+        offset = os.path.getsize(part)
+    headers = {}
+    if offset:
+        headers['Range'] = 'bytes=%d-' % offset
+    try:
+        input = opener(url, headers)
+    except urllib.error.HTTPError as e:
+        if e.code != 416:
+            raise
+        # Range Not Satisfiable: the partial file is unusable.
+        os.remove(part)
+        offset = 0
+        input = opener(url, {})
+    with input:
+        if offset and input.status != 206:
+            # The server ignored our Range request.  Start over.
+            offset = 0
+        hashers = []
+        if file_metadata:
+            hashers = [hashlib.new(h) for h in ('md5', 'sha1') if h in file_metadata]
+        if offset:
+            print('Resuming at byte', offset)
+            hash_file(part, hashers)
+        expected = input.getheader('Content-Length')
+        received = 0
+        with open(part, 'ab' if offset else 'wb') as out:
+            while True:
+                buffer = input.read(CHUNK_SIZE)
+                if len(buffer) == 0:
+                    break
+                for h in hashers:
+                    h.update(buffer)
+                out.write(buffer)
+                if tee != None:
+                    tee(buffer)
+                received += len(buffer)
+        if expected != None and received < int(expected):
+            # The connection was dropped.  Keep the .part file so that
+            # a retry can resume from here.
+            raise http.client.IncompleteRead(b'', int(expected) - received)
+        charset = input.info().get_content_charset() or 'utf-8'
+    if file_metadata:
+        try:
+            verify_download(part, file_metadata, hashers)
+        except ChecksumError:
+            os.remove(part)
+            raise
+    if not binary:
+        transcode(part, charset)
+    os.replace(part, filename)
+
+
+def verify_download(filename, file_metadata, hashers):
+    '''verify_download raises ChecksumError if the size of filename or
+    the digests of hashers disagree with file_metadata.'''
+    if 'size' in file_metadata:
+        size = os.path.getsize(filename)
+        if size != int(file_metadata['size']):
+            raise ChecksumError('%s: size %d, expected %s' % (
+                filename, size, file_metadata['size']))
+    for h in hashers:
+        if h.hexdigest() != file_metadata[h.name]:
+            raise ChecksumError('%s: %s %s, expected %s' % (
+                filename, h.name, h.hexdigest(), file_metadata[h.name]))
+
+
+def file_is_current(filename, file_metadata, previous_metadata=None):
+    '''file_is_current returns True if filename matches file_metadata,
+    the file's entry from its item's current metadata.
+
+    previous_metadata is the entry the file was downloaded against, if
+    known.  Since downloads are verified, a file whose entry hasn't
+    changed only needs its size checked.  Otherwise the file is hashed.'''
+    if not os.path.isfile(filename):
+        return False
+    if 'size' in file_metadata:
+        if os.path.getsize(filename) != int(file_metadata['size']):
+            return False
+    hashes = [h for h in ('md5', 'sha1') if h in file_metadata]
+    if len(hashes) == 0:
+        # Without a hash we can't tell if the content has changed.
+        return (previous_metadata != None and
+                'mtime' in file_metadata and
+                previous_metadata.get('mtime') == file_metadata['mtime'])
+    if previous_metadata != None and all(
+            [previous_metadata.get(h) == file_metadata[h] for h in hashes]):
+        return True
+    hashers = [hashlib.new(h) for h in hashes]
+    hash_file(filename, hashers)
+    return all([h.hexdigest() == file_metadata[h.name] for h in hashers])
+
+
+def transcode(filename, charset):
+    '''transcode rewrites filename, a chunk at a time, from charset to
+    the default encoding used by open.'''
+    decoder = codecs.getincrementaldecoder(charset)('replace')
+    temp = filename + '.text'
+    with open(filename, 'rb') as input:
+        with open(temp, 'w') as out:
+            while True:
+                buffer = input.read(CHUNK_SIZE)
+                out.write(decoder.decode(buffer, len(buffer) == 0))
+                if len(buffer) == 0:
+                    break
+    os.replace(temp, filename)
+
+def fetch_metadata(name, url_template=METADATA_URL_TEMPLATE, cache=None,
+                   opener=open_url):
+    '''fetch_metadata returns the metadata of the named archived
+    document.  If cache, a MetadataCache, is specified it is consulted
+    first.'''
+    if cache != None:
+        return cache.fetch(name, url_template, opener)
+    uri = url_template.format(NAME=name)
+    with opener(uri) as input:
         content = input.read().decode('utf-8')
     return json.loads(content)
 
+
+# The default location of the MetadataCache.
+METADATA_CACHE_DIRECTORY = os.path.join(
+    os.path.expanduser('~'), '.cache', 'library_tools', 'metadata')
+
+
+class MetadataCache (object):
+    '''MetadataCache keeps the metadata of archived documents on disk,
+    one JSON file per document.  An entry younger than ttl seconds is
+    used as is.  An older one is revalidated with a conditional request
+    using the ETag and Last-Modified headers of the response it came
+    from.'''
+
+    def __init__(self, directory=METADATA_CACHE_DIRECTORY, ttl=24 * 60 * 60):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name + '.json')
+
+    def read(self, name):
+        try:
+            with open(self.path(name), 'r') as input:
+                return json.load(input)
+        except (OSError, ValueError):
+            return None
+
+    def write(self, name, entry):
+        # Several threads might be fetching metadata so write a
+        # temporary file and rename it into place.
+        temp = '%s.%d.%d' % (self.path(name), os.getpid(), threading.get_ident())
+        with open(temp, 'w') as output:
+            json.dump(entry, output)
+        os.replace(temp, self.path(name))
+
+    def fetch(self, name, url_template=METADATA_URL_TEMPLATE, opener=open_url):
+        entry = self.read(name)
+        if entry and time.time() - entry['fetched'] < self.ttl:
+            return entry['metadata']
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        uri = url_template.format(NAME=name)
+        try:
+            input = opener(uri, headers)
+        except urllib.error.HTTPError as e:
+            if e.code != 304 or not entry:
+                raise
+            input = e
+        with input:
+            if input.status == 304 and entry:
+                entry['fetched'] = time.time()
+                self.write(name, entry)
+                return entry['metadata']
+            content = input.read().decode('utf-8')
+            entry = {
+                'fetched': time.time(),
+                'etag': input.getheader('ETag'),
+                'last_modified': input.getheader('Last-Modified'),
+                'metadata': json.loads(content)
+            }
+        self.write(name, entry)
+        return entry['metadata']
+
+
 # This is the the value of the "fgormat" attribute of a file entry in
 # an archived document's metadata
 PROCESSED_ZIP_FORMAT = 'Single Page Processed JP2 ZIP'
 
+# The format of the tar file of the page images as they were scanned.
+ORIGINAL_TAR_FORMAT = 'Single Page Original JP2 Tar'
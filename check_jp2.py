@@ -7,6 +7,7 @@
 
 import os
 import os.path
+from collections import namedtuple
 
 
 def scan_all(directory):
@@ -16,6 +17,71 @@ def scan_all(directory):
         fbox.read().show()
 
 
+JP2Size = namedtuple('JP2Size', ('width', 'height'))
+
+
+def probe_size(filepath):
+    '''probe_size returns the JP2Size of the JP2 file at filepath from
+    its image header box.  Only the boxes up to and including the JP2
+    header box are read.  Returns None if there is no image header.'''
+    with open(filepath, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        while f.tell() + 8 <= file_size:
+            box = JP2Box.read_box(f)
+            if box.box_type == 'jp2h':
+                for child in box:
+                    if child.box_type == 'ihdr':
+                        return JP2Size(child.image_width, child.image_height)
+                return None
+    return None
+
+
+def probe_decomposition_levels(filepath):
+    '''probe_decomposition_levels returns the number of wavelet
+    decomposition levels of the JP2 (or raw JPEG 2000 codestream) file
+    at filepath, from the main header of its codestream.  The image can
+    be decoded at 1/2, 1/4 and so on of its full size down to 1/2 to
+    the power of that number.  Returns None if there is no codestream.'''
+    with open(filepath, 'rb') as f:
+        if f.read(2) == SOC_MARKER:
+            f.seek(0)
+            return read_codestream_header(f).decomposition_levels
+        f.seek(0)
+        file_size = os.fstat(f.fileno()).st_size
+        while f.tell() + 8 <= file_size:
+            box = JP2Box.read_box(f)
+            if box.box_type == 'jp2c':
+                return box.header.decomposition_levels
+    return None
+
+
+# Results of probe_size and probe_decomposition_levels keyed by file
+# path.  Each value is the file's modification time and size when it
+# was probed and the result.
+_size_cache = {}
+_decomposition_levels_cache = {}
+
+def _probe_cached(cache, probe, filepath):
+    st = os.stat(filepath)
+    cached = cache.get(filepath)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    result = probe(filepath)
+    cache[filepath] = (st.st_mtime_ns, st.st_size, result)
+    return result
+
+def image_size(filepath):
+    '''image_size returns the JP2Size of the JP2 file at filepath.  The
+    result is remembered until the file is modified.'''
+    return _probe_cached(_size_cache, probe_size, filepath)
+
+def decomposition_levels(filepath):
+    '''decomposition_levels is the remembered result of
+    probe_decomposition_levels.'''
+    return _probe_cached(_decomposition_levels_cache,
+                         probe_decomposition_levels, filepath)
+
+
 def get_tag(header):
     result = ''
     for index in range(4, 8):
@@ -45,7 +111,7 @@ class JP2Box (object):
         if box_size == 1:
             xlbox = f.read(8)
             box_size = big_endian_int(xlbox, bytecount=8)
-            daata_size -= 8
+            data_size = box_size - 16
         elif box_size == 0:
             box_size = os.fstat(f.fileno()).st_size - box_start
         box_type = get_tag(header)
@@ -163,9 +229,7 @@ class JP2ImageHeader(JP2Box):
     box_type = 'ihdr'
 
     def handle_data(self, f):
-        print('ihdr data start', f.tell())
         buffer = f.read(self.data_size)
-        print(buffer)
         # self.major_version = buffer[0]
         # self.minor_version = buffer[1]
         # self.number_of_components = big_endian_int(buffer, 0, 2)
@@ -191,9 +255,7 @@ class JP2ColorSpecification(JP2Box):
     box_type = 'colr'
 
     def handle_data(self, f):
-        print('colr data start', f.tell())
         buffer = f.read(self.data_size)
-        print(buffer)
         self.method = buffer[0]
         # 1 byte "precedence" value ignored
         self.approximation = buffer[2]
@@ -203,3 +265,57 @@ class JP2ColorSpecification(JP2Box):
         else:
             self.icc_profile = buffer[7:]
             
+
+
+# Codestream markers.  See ITU-T T.800 Annex A.
+SOC_MARKER = b'\xff\x4f'
+SIZ_MARKER = b'\xff\x51'
+COD_MARKER = b'\xff\x52'
+COC_MARKER = b'\xff\x53'
+SOT_MARKER = b'\xff\x90'
+
+CodestreamHeader = namedtuple('CodestreamHeader',
+                              ('width', 'height', 'components',
+                               'decomposition_levels'))
+
+def read_codestream_header(f):
+    '''read_codestream_header reads the main header of the JPEG 2000
+    codestream that starts at the current position of f, stopping at
+    the first tile.'''
+    if f.read(2) != SOC_MARKER:
+        raise Exception('No JPEG 2000 codestream at %d' % (f.tell() - 2))
+    width = height = components = levels = None
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker == SOT_MARKER:
+            break
+        segment = f.read(big_endian_int(f.read(2), 0, 2) - 2)
+        if marker == SIZ_MARKER:
+            width = big_endian_int(segment, 2) - big_endian_int(segment, 10)
+            height = big_endian_int(segment, 6) - big_endian_int(segment, 14)
+            components = big_endian_int(segment, 34, 2)
+        elif marker == COD_MARKER:
+            # Scod, progression order, layers and multiple component
+            # transformation come first.
+            levels = min_none(levels, segment[5])
+        elif marker == COC_MARKER:
+            # A component can have its own number of levels.
+            offset = 1 if components != None and components < 257 else 2
+            levels = min_none(levels, segment[offset + 1])
+    return CodestreamHeader(width, height, components, levels)
+
+def min_none(a, b):
+    if a == None:
+        return b
+    return min(a, b)
+
+
+class JP2CodestreamBox(JP2Box):
+    box_type = 'jp2c'
+
+    def handle_data(self, f):
+        self.header = read_codestream_header(f)
+        f.seek(self.box_end, os.SEEK_SET)
+
+    def details(self):
+        return '%dw %dh %d components %d levels' % self.header
@@ -0,0 +1,109 @@
+# Making the images that are derived from the pages of a Book:
+# thumbnails, thumbnails with the pictures highlighted and renderings
+# of just the graphics.
+#
+# Decoding a page's JP2 file is independent CPU bound work, so pages
+# are farmed out to a pool of processes.  Only the page's file path and
+# the coordinates of its regions are sent to a worker, and the page
+# image is decoded once for all of the outputs that are wanted for it.
+
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import image_cache
+import page
+from region import Region
+
+
+# The kinds of output.
+THUMBNAIL = 'thumbnail'
+HIGHLIGHT_THUMBNAIL = 'hli'
+GRAPHICS = 'graphics'
+
+OUTPUTS = (THUMBNAIL, HIGHLIGHT_THUMBNAIL, GRAPHICS)
+
+
+# PageJob is what a worker is given to make the outputs for one page.
+# size is the full resolution size of the page image and regions are
+# (left, right, top, bottom) tuples in full resolution coordinates.  reduce is the JPEG 2000 resolution reduction to decode
+# at if only thumbnails are wanted.  outputs is a tuple of (kind, path)
+# pairs.
+PageJob = namedtuple('PageJob',
+                     ('jp2filepath', 'size', 'reduce', 'background_strip_width',
+                      'picture_regions', 'text_regions', 'outputs'))
+
+
+def region_tuple(r):
+    return (r.left, r.right, r.top, r.bottom)
+
+
+def page_job(p, outputs):
+    '''page_job returns the PageJob for making outputs for the Page p.
+    Graphics only images can't be made for pages that have no OCR data.'''
+    paths = []
+    for kind in outputs:
+        if kind == THUMBNAIL:
+            paths.append((kind, p.thumbnail_path()))
+        elif kind == HIGHLIGHT_THUMBNAIL:
+            paths.append((kind, p.thumbnail_path('hli')))
+        elif kind == GRAPHICS:
+            if p.metadata != None:
+                paths.append((kind, p.graphics_path()))
+        else:
+            raise Exception('Unknown derivative kind %r' % kind)
+    graphics = GRAPHICS in dict(paths)
+    return PageJob(
+        p.jp2filepath,
+        (p.jp2_width, p.jp2_height),
+        p.reduction_for_size(page.THUMBNAIL_SIZE),
+        p.background_strip_width() if graphics else None,
+        [region_tuple(r) for r in p.picture_regions],
+        [region_tuple(r) for r in p.paragraph_text_regions()] if graphics else [],
+        tuple(paths))
+
+
+def make_page_derivatives(job):
+    '''make_page_derivatives writes the outputs of the PageJob job and
+    returns their paths.  It is run in a worker process.'''
+    outputs = dict(job.outputs)
+    if len(outputs) == 0:
+        return []
+    # The graphics only image is full size.  Thumbnails can be made from
+    # a reduced resolution decode.
+    reduce = 0 if GRAPHICS in outputs else job.reduce
+    img = image_cache.decode(job.jp2filepath, reduce)
+    def regions(tuples):
+        return [Region(*t).scaled(job.size, img.size) for t in tuples]
+    if THUMBNAIL in outputs:
+        thumbnail = img.copy()
+        thumbnail.thumbnail(page.THUMBNAIL_SIZE)
+        thumbnail.save(outputs[THUMBNAIL], 'JPEG')
+    if HIGHLIGHT_THUMBNAIL in outputs:
+        hli = img.copy()
+        page.hilite_regions(hli, regions(job.picture_regions))
+        hli.thumbnail(page.THUMBNAIL_SIZE)
+        hli.save(outputs[HIGHLIGHT_THUMBNAIL], 'JPEG')
+    if GRAPHICS in outputs:
+        page.graphics_only_image(img, job.background_strip_width,
+                                 regions(job.text_regions))
+        img.save(outputs[GRAPHICS], 'PNG')
+    return [path for kind, path in job.outputs]
+
+
+def make_derivatives(book, outputs, processes=None):
+    '''make_derivatives writes outputs, a sequence of the output kinds
+    above, for each page of book using processes worker processes.  It
+    returns a list, in page order, of the paths written for each page.
+    If processes is 1 the work is done in this process.'''
+    for kind in outputs:
+        if kind not in OUTPUTS:
+            raise Exception('Unknown derivative kind %r' % kind)
+    if THUMBNAIL in outputs or HIGHLIGHT_THUMBNAIL in outputs:
+        os.makedirs(book.thumbnails_dir(), exist_ok=True)
+    if GRAPHICS in outputs:
+        os.makedirs(book.graphics_dir(), exist_ok=True)
+    jobs = [page_job(p, outputs) for p in book.pages]
+    if processes == 1:
+        return [make_page_derivatives(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(make_page_derivatives, jobs))
@@ -0,0 +1,291 @@
+# Concurrent downloading of files from archive.org.
+#
+# A Downloader runs archive_org.fetch_url_to_file in a bounded pool of
+# worker threads.  Each worker keeps one persistent connection per
+# host, failed transfers are retried with exponential backoff, and
+# any post-download action is run by the worker as soon as its file
+# has landed.  A retried transfer resumes from where the failed one
+# stopped.  A file can also be consumed as a stream while it is being
+# downloaded.
+
+import http.client
+import os.path
+import queue
+import threading
+import time
+import urllib.error
+import urllib.parse
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_EXCEPTION
+import archive_org
+
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+class HostConnections (object):
+    '''HostConnections keeps a persistent HTTP connection to each host
+    for each thread that uses it, so successive requests to the same
+    server don't each pay for a new TCP and TLS handshake.  Its open
+    method can be passed as the opener to archive_org.fetch_url_to_file.'''
+
+    MAX_REDIRECTS = 5
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connections(self):
+        connections = getattr(self.local, 'connections', None)
+        if connections == None:
+            connections = self.local.connections = {}
+        return connections
+
+    def connection(self, scheme, netloc):
+        connections = self._connections()
+        conn = connections.get((scheme, netloc))
+        if conn == None:
+            if scheme == 'https':
+                conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            elif scheme == 'http':
+                conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            else:
+                raise Exception('Unsupported URL scheme %r' % scheme)
+            connections[(scheme, netloc)] = conn
+        return conn
+
+    def reset(self):
+        '''reset closes all of the current thread's connections.  It
+        should be called after a failed transfer since the state of
+        the connection is then unknown.'''
+        connections = self._connections()
+        for conn in connections.values():
+            conn.close()
+        connections.clear()
+
+    def open(self, url, headers=None):
+        '''open issues a GET request for url and returns the response,
+        following redirects.  The response must be read to the end
+        before the thread makes another request to the same host.'''
+        for redirect in range(self.MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            conn = self.connection(parts.scheme, parts.netloc)
+            try:
+                conn.request('GET', path, headers=headers or {})
+                response = conn.getresponse()
+            except (OSError, http.client.HTTPException):
+                self.reset()
+                raise
+            if response.status in REDIRECT_STATUSES:
+                response.read()
+                url = urllib.parse.urljoin(url, response.getheader('Location'))
+                continue
+            if response.status >= 400:
+                response.read()
+                raise urllib.error.HTTPError(url, response.status, response.reason,
+                                             response.headers, None)
+            response.url = url
+            return response
+        raise urllib.error.URLError('Too many redirects: %s' % url)
+
+
+def retryable(exception):
+    '''retryable returns True if a download that failed with exception
+    might succeed if tried again.'''
+    if isinstance(exception, archive_org.ChecksumError):
+        return True
+    if isinstance(exception, urllib.error.HTTPError):
+        return exception.code >= 500 or exception.code == 429
+    return isinstance(exception, (OSError, http.client.HTTPException))
+
+
+class Downloader (object):
+    '''Downloader fetches files concurrently using a bounded pool of
+    worker threads.  It can be used as a context manager, which waits
+    for all submitted downloads when it exits.'''
+
+    def __init__(self, workers=4, retries=4, backoff=1.0,
+                 url_template=archive_org.FILE_FETCH_URL_TEMPLATE):
+        '''url_template is used to construct the URL for a file from
+        the "dir" of its item's metadata and its name.  Pointing it at
+        a local server is useful for testing.'''
+        self.retries = retries
+        self.backoff = backoff
+        self.url_template = url_template
+        self.connections = HostConnections()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def file_url(self, remote_dir, name):
+        return self.url_template.format(DIR=remote_dir, NAME=name)
+
+    def submit(self, url, filename, action=None, binary=True, file_metadata=None,
+               stream_action=None):
+        '''submit schedules url to be downloaded to filename and returns
+        a Future whose result is filename.  If action is specified it is
+        called with no arguments by the worker once the file is
+        complete.  file_metadata is the file's entry from its item's
+        metadata, used to verify the download.
+
+        If stream_action is specified it is called in another thread,
+        as soon as the download starts, with a file-like StreamPipe
+        that it can read the data from as it arrives.  If streaming
+        fails, for instance because the transfer had to be resumed,
+        action is called once the file is complete instead.'''
+        return self.executor.submit(self._download, url, filename, action,
+                                    binary, file_metadata, stream_action)
+
+    def submit_action(self, action):
+        '''submit_action schedules action to be called by a worker.  It
+        is used when a file is already present but its post-download
+        action still needs to be run.'''
+        return self.executor.submit(action)
+
+    def _download(self, url, filename, action, binary, file_metadata,
+                  stream_action=None):
+        delay = self.backoff
+        attempt = 0
+        pipe = None
+        streamed = None
+        if stream_action != None and not os.path.exists(filename + '.part'):
+            pipe = StreamPipe()
+            streamed = pipe.consume(stream_action)
+        while True:
+            try:
+                archive_org.fetch_url_to_file(url, filename, binary=binary,
+                                              opener=self.connections.open,
+                                              file_metadata=file_metadata,
+                                              tee=pipe and pipe.write)
+                if pipe != None:
+                    pipe.close()
+                break
+            except Exception as e:
+                self.connections.reset()
+                if pipe != None:
+                    # The next attempt resumes part way through the file,
+                    # so the stream can't be continued.
+                    pipe.abort()
+                    pipe = None
+                attempt += 1
+                if attempt > self.retries or not retryable(e):
+                    raise
+                print('Retrying %s in %gs after %r' % (url, delay, e))
+                time.sleep(delay)
+                delay *= 2
+        print('Wrote', filename)
+        if streamed != None:
+            try:
+                streamed.result()
+                return filename
+            except Exception as e:
+                print('Processing %s while downloading failed: %r' % (filename, e))
+        if action != None:
+            action()
+        return filename
+
+
+class StreamPipe (object):
+    '''StreamPipe passes the chunks of a download from the thread that
+    is downloading it to a thread that reads it as a file.  At most
+    max_chunks chunks are buffered.'''
+
+    EOF = None
+    ABORT = object()
+
+    def __init__(self, max_chunks=16):
+        self.queue = queue.Queue(max_chunks)
+        self.buffer = b''
+        self.at_eof = False
+        # Set once the reader has stopped reading, so that the writer
+        # doesn't wait for it forever.
+        self.reader_done = threading.Event()
+
+    def _put(self, item):
+        while not self.reader_done.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def write(self, data):
+        if len(data) > 0:
+            self._put(data)
+
+    def close(self):
+        self._put(self.EOF)
+
+    def abort(self):
+        self._put(self.ABORT)
+
+    def _get(self):
+        item = self.queue.get()
+        if item is self.ABORT:
+            raise EOFError('Download was abandoned')
+        if item is self.EOF:
+            self.at_eof = True
+            return b''
+        return item
+
+    def read(self, n=-1):
+        parts = [self.buffer]
+        have = len(self.buffer)
+        while not self.at_eof and (n < 0 or have < n):
+            chunk = self._get()
+            parts.append(chunk)
+            have += len(chunk)
+        data = b''.join(parts)
+        if n < 0:
+            n = len(data)
+        self.buffer = data[n:]
+        return data[:n]
+
+    def consume(self, function):
+        '''consume starts a thread that calls function with this pipe as
+        its argument and returns a Future for its result.'''
+        future = Future()
+        def run():
+            try:
+                future.set_result(function(self))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                self.reader_done.set()
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+
+def wait_for(futures):
+    '''wait_for waits until all of futures are done, or until one of
+    them fails, in which case its exception is raised.'''
+    done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+    for f in done:
+        f.result()
+    return [f.result() for f in futures]
+
+
+def fetch_metadata_batch(names, workers=8, cache=None,
+                         url_template=archive_org.METADATA_URL_TEMPLATE):
+    '''fetch_metadata_batch fetches the metadata of each of the named
+    archived documents concurrently and returns a dict mapping name to
+    metadata.  cache, if specified, is an archive_org.MetadataCache.'''
+    connections = HostConnections()
+    def fetch(name):
+        try:
+            return archive_org.fetch_metadata(name, url_template, cache,
+                                              opener=connections.open)
+        except Exception:
+            connections.reset()
+            raise
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(names, executor.map(fetch, names)))
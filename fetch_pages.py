@@ -1,14 +1,19 @@
 #!python3
 
 import argparse
+import functools
 import json
 import sys
 import os
 import os.path
+import abbyy
 import archive_org
+import derivatives
+import downloader
+import jp2_archive
 import zipfile
-import gzip
 import page
+import remote_zip
 from collections import namedtuple
 from write_html import write_html
 
@@ -40,49 +45,129 @@ page, but the available OCR data does not facilitate that.
 
 parser.add_argument('book_title_path_component', type=str, nargs='+')
 
+parser.add_argument('--workers', type=int, default=4,
+                    help='the number of files to download concurrently.')
+
+parser.add_argument('--processes', type=int, default=None,
+                    help='''the number of processes to make page thumbnails
+with.  The default is the number of CPUs.''')
+
+parser.add_argument('--incremental', action='store_true',
+                    help='''update the directories of books that have already
+been fetched, downloading only those files that are missing or have
+changed.''')
+
+parser.add_argument('--metadata-ttl', type=float, default=0,
+                    help='''the number of seconds for which cached item metadata
+is used without asking archive.org if it has changed.''')
+
+parser.add_argument('--pages', type=str, default=None,
+                    help='''only fetch the images of the pages with these
+sequence numbers, for example "1,5,10-20".  The selected pages are read
+directly from the JP2 zip file on archive.org without downloading all
+of it.''')
+
+parser.add_argument('--picture-pages', action='store_true',
+                    help='''only fetch the images of those pages on which ABBYY
+found a picture.''')
+
+
+def parse_page_ranges(spec):
+    '''parse_page_ranges returns the set of sequence numbers described
+    by spec, a comma separated list of numbers and ranges like "10-20".'''
+    pages = set()
+    for part in spec.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            pages.update(range(int(first), int(last) + 1))
+        else:
+            pages.add(int(part))
+    return pages
+
+
 def main():
     args = parser.parse_args()
-    for book in args.book_title_path_component:
-        fetch_book(book)
-        b = page.Book(book)
-        b.make_thumbnails()
-        write_html(b)
+    # Downloads for all of the books share one pool of workers.  Each
+    # book is processed as soon as its own files have arrived.
+    metadata = downloader.fetch_metadata_batch(
+        args.book_title_path_component, workers=args.workers,
+        cache=archive_org.MetadataCache(ttl=args.metadata_ttl))
+    pages = None
+    if args.picture_pages:
+        pages = PICTURE_PAGES
+    elif args.pages:
+        pages = parse_page_ranges(args.pages)
+    with downloader.Downloader(workers=args.workers) as dl:
+        pending = [(book, start_fetch_book(book, dl, incremental=args.incremental,
+                                           metadata=metadata[book], pages=pages))
+                   for book in args.book_title_path_component]
+        for book, futures in pending:
+            downloader.wait_for(futures)
+            print('Book downloaded to', book)
+            b = page.Book(book)
+            b.make_derivatives((derivatives.THUMBNAIL,
+                                derivatives.HIGHLIGHT_THUMBNAIL),
+                               processes=args.processes)
+            write_html(b)
+
 
+# action is called with the file's metadata, the downloaded file and
+# the book's directory once the file has been downloaded.  If
+# outputs_current is not None it is called with the same arguments and
+# should return True if the files that action would write already
+# reflect the downloaded file.  If stream_action is not None it is
+# called with the file's metadata, the book's directory and a stream of
+# the file's content while it is being downloaded, and action is only
+# called if that fails.
+DownloadFormat = namedtuple('DownLoadFormat',
+                            ('format', 'action', 'outputs_current', 'stream_action'))
 
-DownloadFormat = namedtuple('DownLoadFormat', ('format', 'action'))
+
+JP2_ARCHIVE_FORMATS = (archive_org.PROCESSED_ZIP_FORMAT,
+                       archive_org.ORIGINAL_TAR_FORMAT)
 
 
 def extract_jp2_archive(file_metadata, fetched_file, target_directory):
-    assert file_metadata['format'] == 'Single Page Processed JP2 ZIP'
+    assert file_metadata['format'] in JP2_ARCHIVE_FORMATS
+    pages_dir = os.path.join(target_directory, 'pages')
+    os.makedirs(pages_dir, exist_ok=True)
+    jp2_archive.extract_file(fetched_file, file_metadata['format'], pages_dir)
+
+
+def extract_jp2_stream(file_metadata, target_directory, stream):
+    assert file_metadata['format'] in JP2_ARCHIVE_FORMATS
+    pages_dir = os.path.join(target_directory, 'pages')
+    os.makedirs(pages_dir, exist_ok=True)
+    jp2_archive.extract_stream(stream, file_metadata['format'], pages_dir)
+
+
+def jp2_archive_extracted(file_metadata, fetched_file, target_directory):
+    '''jp2_archive_extracted returns True if every member of the JP2
+    archive is already present in the pages directory with the right
+    size.'''
     pages_dir = os.path.join(target_directory, 'pages')
-    os.mkdir(pages_dir)
-    zf = zipfile.ZipFile(fetched_file, 'r')
-    for page in zf.namelist():
-        zf.extract(page, path=pages_dir)
-
-
-def unzib_abbyy(file_metadata, fetched_file, target_directory):
-    print(fetched_file)
-    assert file_metadata['format'] == 'Abbyy GZ'
-    f = gzip.open(fetched_file, 'rb')
-    directory, filename = os.path.split(fetched_file)
-    base = filename.rsplit('.', 1)[0]
-    outfile = os.path.join(directory, base + '.xml')
-    with open(outfile, 'wb') as out:
-        while True:
-            buffer = f.read(10000)
-            if len(buffer) == 0:
-                break
-            out.write(buffer)
+    with zipfile.ZipFile(fetched_file, 'r') as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            path = os.path.join(pages_dir, info.filename)
+            if not os.path.isfile(path):
+                return False
+            if os.path.getsize(path) != info.file_size:
+                return False
+    return True
 
 
 DOWNLOAD_FORMATS = [
-    DownloadFormat('Metadata', None),
-    DownloadFormat('Djvu XML', None),
-    DownloadFormat('Dublin Core', None),
-    DownloadFormat('Abbyy GZ', unzib_abbyy),
+    DownloadFormat('Metadata', None, None, None),
+    DownloadFormat('Djvu XML', None, None, None),
+    DownloadFormat('Dublin Core', None, None, None),
+    # page.Book reads the ABBYY file without decompressing it first.
+    DownloadFormat('Abbyy GZ', None, None, None),
     # ??? Should we be working with the processed or the original jp2 files?
-    DownloadFormat('Single Page Processed JP2 ZIP', extract_jp2_archive)
+    # jp2_archive can also extract the 'Single Page Original JP2 Tar'.
+    DownloadFormat('Single Page Processed JP2 ZIP', extract_jp2_archive,
+                   jp2_archive_extracted, extract_jp2_stream)
     ]
 
 
@@ -93,30 +178,126 @@ def want_download(format):
     return None
 
 
-def fetch_book(book):
+def fetch_book(book, workers=4, url_template=archive_org.FILE_FETCH_URL_TEMPLATE,
+               metadata_url_template=archive_org.METADATA_URL_TEMPLATE,
+               incremental=False):
+    with downloader.Downloader(workers=workers, url_template=url_template) as dl:
+        downloader.wait_for(start_fetch_book(book, dl, metadata_url_template,
+                                             incremental))
+    print('Book downloaded to', os.path.abspath(book))
+
+
+# The pages argument to start_fetch_book can be this to select those
+# pages on which ABBYY found pictures.
+PICTURE_PAGES = 'pictures'
+
+
+def run_actions(actions):
+    for action in actions:
+        if action != None:
+            action()
+
+
+def start_fetch_book(book, dl,
+                     metadata_url_template=archive_org.METADATA_URL_TEMPLATE,
+                     incremental=False, metadata=None, pages=None):
+    """start_fetch_book creates the directory for book, writes its
+    metadata there and schedules the download of each of its files with
+    the Downloader dl.  It returns the list of the downloads' Futures.
+
+    If incremental is true then the book's directory may already
+    exist.  Only those files which are missing or differ from the
+    item's current metadata are downloaded, and the actions of files
+    that are already present are only run if their outputs are out of
+    date.
+
+    metadata is the item's metadata if it has already been fetched.
+
+    If pages is specified then rather than downloading the whole JP2
+    zip file only the images of the selected pages are read from it.
+    pages is either a set of page sequence numbers or PICTURE_PAGES."""
     d = os.path.join(os.path.abspath(os.curdir), book)
-    os.mkdir(d)
     metadata_file = os.path.join(d, 'metadata.json')
-    metadata = archive_org.fetch_metadata(book)
+    previous_files = {}
+    if incremental and os.path.isdir(d):
+        if os.path.isfile(metadata_file):
+            with open(metadata_file, 'r') as input:
+                previous_files = { f['name']: f for f in json.load(input)['files'] }
+    else:
+        os.mkdir(d)
+    if metadata == None:
+        metadata = archive_org.fetch_metadata(book, metadata_url_template)
     with open(metadata_file, 'w') as output:
         json.dump(metadata, output, indent='  ')
     remote_dir = metadata['dir']
     remote_files = metadata['files']
+    futures = []
+    fetch_selected = None
+    if pages != None:
+        fetch_selected = selected_pages_action(book, dl, d, remote_dir,
+                                               remote_files, pages)
     for f in remote_files:
-        this_file = None
         download_format = want_download(f['format'])
         if download_format == None:
             continue
+        if pages != None and f['format'] == archive_org.PROCESSED_ZIP_FORMAT:
+            continue
         this_file = os.path.join(d, f['name'])
-        archive_org.fetch_url_to_file(
-            archive_org.FILE_FETCH_URL_TEMPLATE.format(
-                DIR=remote_dir,
-                NAME=f['name']),
-            this_file, binary=True)
-        print('Wrote', this_file)
+        action = None
         if download_format.action != None:
-            download_format.action(f, this_file, d)
-    print('Book downloaded to', d)
+            action = functools.partial(download_format.action, f, this_file, d)
+        # The ABBYY file tells us which pages have pictures, so those
+        # pages are fetched once it has arrived.
+        picture_pages_action = None
+        if pages == PICTURE_PAGES and f['format'] == 'Abbyy GZ':
+            picture_pages_action = fetch_selected
+        if incremental and archive_org.file_is_current(
+                this_file, f, previous_files.get(f['name'])):
+            if (download_format.outputs_current != None and
+                download_format.outputs_current(f, this_file, d)):
+                action = None
+            if action != None or picture_pages_action != None:
+                futures.append(dl.submit_action(functools.partial(
+                    run_actions, [action, picture_pages_action])))
+            continue
+        if os.path.exists(this_file):
+            # Remove the stale copy so that, should the download fail,
+            # it isn't mistaken for the version recorded in metadata_file.
+            os.remove(this_file)
+        if picture_pages_action != None:
+            action = functools.partial(run_actions, [action, picture_pages_action])
+        stream_action = None
+        if download_format.stream_action != None:
+            stream_action = functools.partial(download_format.stream_action, f, d)
+        futures.append(dl.submit(dl.file_url(remote_dir, f['name']),
+                                 this_file, action, file_metadata=f,
+                                 stream_action=stream_action))
+    if pages != None and pages != PICTURE_PAGES:
+        futures.append(dl.submit_action(fetch_selected))
+    return futures
+
+
+def selected_pages_action(book, dl, d, remote_dir, remote_files, pages):
+    """selected_pages_action returns a function that extracts the
+    selected pages from the book's remote JP2 zip file."""
+    zip_files = [f for f in remote_files
+                 if f['format'] == archive_org.PROCESSED_ZIP_FORMAT]
+    if len(zip_files) == 0:
+        raise Exception('%s has no %s' % (book, archive_org.PROCESSED_ZIP_FORMAT))
+    url = dl.file_url(remote_dir, zip_files[0]['name'])
+    if pages != PICTURE_PAGES:
+        return functools.partial(remote_zip.fetch_selected_pages, url, d,
+                                 sequence_numbers=pages,
+                                 opener=dl.connections.open)
+    abbyy_files = [f for f in remote_files if f['format'] == 'Abbyy GZ']
+    if len(abbyy_files) == 0:
+        raise Exception('%s has no ABBYY file to find pictures in' % book)
+    abbyy_file = os.path.join(d, abbyy_files[0]['name'])
+    def fetch_picture_pages():
+        remote_zip.fetch_selected_pages(
+            url, d, page_indexes=abbyy.picture_page_indexes(abbyy_file),
+            opener=dl.connections.open)
+    return fetch_picture_pages
 
 
 if __name__ == '__main__':
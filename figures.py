@@ -0,0 +1,135 @@
+#!python3
+
+# Exporting the figures that ABBYY found on the pages of a book, as
+# separate image files suitable for uploading to the WikiMedia Commons.
+#
+# A JPEG 2000 decoder can decode just the part of an image that covers
+# a given area, and at a reduced resolution.  If glymur is installed it
+# is used to decode only the area of each figure.  Otherwise each page
+# with figures is decoded once, at the chosen resolution, using Pillow
+# and the figures are cropped from that.
+
+import argparse
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+import image_cache
+import page
+from derivatives import region_tuple
+from region import Region
+
+try:
+    import glymur     # pip install glymur
+except ImportError:
+    glymur = None
+
+
+# FigureJob is what a worker is given to export the figures of one page.
+# size is the full resolution size of the page image.  Regions are
+# (left, right, top, bottom) tuples in full resolution coordinates,
+# already clipped to the page.  paths are where each
+# region's image is written.
+FigureJob = namedtuple('FigureJob',
+                       ('jp2filepath', 'size', 'reduce', 'regions', 'paths'))
+
+
+def figure_path(p, index, format='png'):
+    '''figure_path returns the path of the file for the index'th picture
+    region of the Page p.'''
+    return os.path.join(p.book.figures_dir(),
+                        '%04d_%d.%s' % (p.sequence_number, index, format))
+
+
+def clip_region(region, whole):
+    return Region(max(region.left, whole.left), min(region.right, whole.right),
+                  max(region.top, whole.top), min(region.bottom, whole.bottom))
+
+
+def figure_job(p, reduce=0, format='png'):
+    '''figure_job returns the FigureJob for exporting the picture regions
+    of the Page p at the resolution reduced by 2 to the power of reduce.'''
+    regions = []
+    paths = []
+    for index, r in enumerate(p.picture_regions):
+        r = clip_region(r, p.jp2_region)
+        if r.width <= 0 or r.height <= 0:
+            continue
+        regions.append(region_tuple(r))
+        paths.append(figure_path(p, index, format))
+    return FigureJob(p.jp2filepath, (p.jp2_width, p.jp2_height), reduce,
+                     regions, paths)
+
+
+def decode_area(jp2filepath, region, reduce=0):
+    '''decode_area uses glymur to decode only the part of the JP2 file at
+    jp2filepath that covers region, at the resolution reduced by 2 to
+    the power of reduce.'''
+    jp2 = glymur.Jp2k(jp2filepath)
+    # glymur decodes a slice with a step that is a power of 2 at the
+    # corresponding reduced resolution.
+    step = 1 << reduce
+    return Image.fromarray(jp2[region.top:region.bottom:step,
+                               region.left:region.right:step])
+
+
+def export_page_figures(job):
+    '''export_page_figures writes the figures of the FigureJob job and
+    returns their paths.  It is run in a worker process.'''
+    if len(job.regions) == 0:
+        return []
+    regions = [Region(*t) for t in job.regions]
+    if glymur != None:
+        for r, path in zip(regions, job.paths):
+            decode_area(job.jp2filepath, r, job.reduce).save(path)
+        return job.paths
+    img = image_cache.decode(job.jp2filepath, job.reduce)
+    for r, path in zip(regions, job.paths):
+        r = r.scaled(job.size, img.size)
+        img.crop((r.left, r.top, r.right, r.bottom)).save(path)
+    return job.paths
+
+
+def export_figures(book, reduce=0, processes=None, format='png'):
+    '''export_figures writes an image file for each of the picture regions
+    of each page of book, using processes worker processes.  The images
+    are reduced in size by 2 to the power of reduce, which should not be
+    more than the number of resolution levels of the page images.  A list
+    of the paths written is returned.'''
+    os.makedirs(book.figures_dir(), exist_ok=True)
+    jobs = [figure_job(p, reduce, format)
+            for p in book.pages if len(p.picture_regions) > 0]
+    if processes == 1:
+        results = [export_page_figures(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(export_page_figures, jobs))
+    return [path for paths in results for path in paths]
+
+
+parser = argparse.ArgumentParser(description='''
+%(prog)s writes an image file for each of the figures that ABBYY found
+in a book that was fetched by fetch_pages.py to the figures
+subdirectory of the book's directory.''')
+
+parser.add_argument('book_directory', type=str, nargs='+')
+
+parser.add_argument('--reduce', type=int, default=0,
+                    help='''reduce the resolution of the figures by a factor
+of 2 to this power.''')
+
+parser.add_argument('--processes', type=int, default=None,
+                    help='''the number of processes to decode pages with.
+The default is the number of CPUs.''')
+
+
+def main():
+    args = parser.parse_args()
+    for directory in args.book_directory:
+        book = page.Book(directory)
+        paths = export_figures(book, reduce=args.reduce, processes=args.processes)
+        print('Wrote %d figures to %s' % (len(paths), book.figures_dir()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+# A cache of decoded page images.
+#
+# Decoding a page's JP2 file is by far the most expensive part of
+# looking at its pixels, and several analyses of the same page each
+# used to decode it afresh.  When the cache is enabled, with
+# image_cache.enable, Page decodes each page image once and keeps it
+# for as long as the total size of the cached pixels stays within the
+# budget, discarding the least recently used images first.
+#
+# The cached Images are shared.  Page.image returns a copy, which can be
+# modified freely.  Page.shared_image returns the cached Image itself
+# and must only be read.
+
+import os
+import threading
+from collections import OrderedDict
+from PIL import Image
+
+
+def image_bytes(img):
+    '''image_bytes returns the size of the pixel data of img.'''
+    return img.size[0] * img.size[1] * len(img.getbands())
+
+
+class DecodedImageCache (object):
+    '''DecodedImageCache keeps decoded images keyed by file path and JPEG
+    2000 resolution reduction.  An image is decoded again if its file
+    has been modified since it was cached.  At most max_bytes of pixel
+    data are kept.'''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        # (path, reduce) -> (mtime_ns, file size, Image)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, reduce=0, decoder=None):
+        '''get returns the decoded image of the file at path, reduced in
+        size by 2 to the power of reduce.  The Image must not be
+        modified.  If it isn't cached, decoder, which defaults to the
+        decode function below, is called with path and reduce to get it.'''
+        st = os.stat(path)
+        key = (path, reduce)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry != None:
+                if entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[2]
+                self._remove(key)
+            self.misses += 1
+        img = (decoder or decode)(path, reduce)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            size = image_bytes(img)
+            if size <= self.max_bytes:
+                self.entries[key] = (st.st_mtime_ns, st.st_size, img)
+                self.total_bytes += size
+                while self.total_bytes > self.max_bytes:
+                    self._remove(next(iter(self.entries)))
+        return img
+
+    def _remove(self, key):
+        mtime, file_size, img = self.entries.pop(key)
+        self.total_bytes -= image_bytes(img)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+
+def reduced_size(size, reduce):
+    '''reduced_size returns the size of an image of size when it is
+    reduced by 2 to the power of reduce, rounding up as OpenJPEG does.'''
+    return tuple([-(-s >> reduce) for s in size])
+
+
+def decodable_reduce(size, reduce):
+    '''decodable_reduce returns the largest level, no more than reduce,
+    at which Pillow can decode a JPEG 2000 image of size.  Pillow rounds
+    the reduced dimensions half up but OpenJPEG rounds them up, and
+    loading fails with "broken data stream" when the two differ.'''
+    while reduce > 0:
+        power = 1 << reduce
+        if all([(s + (power >> 1)) // power == -(-s // power) for s in size]):
+            return reduce
+        reduce -= 1
+    return 0
+
+
+def decode(path, reduce=0):
+    '''decode opens and decodes the image file at path, reduced in size
+    by 2 to the power of reduce if it is a JPEG 2000 file, to
+    reduced_size.  The JPEG 2000 decoder does as much of the reduction as
+    decodable_reduce allows and Image.reduce does the rest.'''
+    img = Image.open(path)
+    if not reduce or img.format != 'JPEG2000':
+        img.load()
+        return img
+    level = decodable_reduce(img.size, reduce)
+    img.reduce = level
+    img.load()
+    if level < reduce:
+        # Jpeg2KImageFile's reduce property hides the method.
+        img = Image.Image.reduce(img, 1 << (reduce - level))
+    return img
+
+
+# The cache that Page uses, or None if caching is disabled.
+_cache = None
+
+def enable(max_bytes):
+    '''enable turns on caching of decoded page images with a budget of
+    max_bytes of pixel data and returns the cache.'''
+    global _cache
+    _cache = DecodedImageCache(max_bytes)
+    return _cache
+
+def disable():
+    global _cache
+    _cache = None
+
+def current():
+    '''current returns the cache in use, or None.'''
+    return _cache
@@ -0,0 +1,318 @@
+# Extracting the page images from the JP2 archives that archive.org
+# provides for a book.
+#
+# The "Single Page Processed JP2 ZIP" is a zip file and the "Single
+# Page Original JP2 Tar" is a tar file.  Either can be extracted from a
+# file that has already been downloaded or from a stream while it is
+# still being downloaded.  Members are handed to a pool of threads to
+# be written, so decompression, writing and the download overlap.
+# Members that have already been extracted are skipped.
+
+import os
+import os.path
+import struct
+import tarfile
+import threading
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from archive_org import PROCESSED_ZIP_FORMAT, ORIGINAL_TAR_FORMAT
+
+CHUNK_SIZE = 1 << 20
+
+
+def member_path(directory, name):
+    '''member_path returns where the archive member name should be
+    written within directory.  Names that would escape directory are
+    rejected.'''
+    name = os.path.normpath(name.replace('\\', '/'))
+    if os.path.isabs(name) or name.startswith('..'):
+        raise Exception('Unsafe archive member name %r' % name)
+    return os.path.join(directory, name)
+
+
+def file_crc(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        while True:
+            buffer = f.read(CHUNK_SIZE)
+            if len(buffer) == 0:
+                break
+            crc = zlib.crc32(buffer, crc)
+    return crc
+
+
+def already_extracted(path, size, crc=None, mtime=None):
+    '''already_extracted returns True if path exists with the expected
+    size and either crc or modification time.'''
+    if not os.path.isfile(path) or os.path.getsize(path) != size:
+        return False
+    if crc != None:
+        return file_crc(path) == crc
+    if mtime != None:
+        return int(os.path.getmtime(path)) == int(mtime)
+    return False
+
+
+def preallocate(f, size):
+    '''preallocate reserves size bytes on disk for the open file f so the
+    file system can lay it out contiguously.'''
+    if size <= 0:
+        return
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            pass
+    f.truncate(size)
+
+
+class MemberWriter (object):
+    '''MemberWriter writes archive members to disk using a pool of
+    threads.  The number of members that have been read but not yet
+    written is bounded so memory use stays bounded.'''
+
+    def __init__(self, workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(2 * workers)
+        self.futures = []
+        # The counts are updated from the pool's threads.
+        self.count_lock = threading.Lock()
+        self.written = 0
+        self.skipped = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.executor.shutdown(wait=True)
+        if exc_type == None:
+            for f in self.futures:
+                f.result()
+
+    def submit(self, function, *args):
+        self.slots.acquire()
+        def run():
+            try:
+                return function(*args)
+            finally:
+                self.slots.release()
+        self.futures.append(self.executor.submit(run))
+
+    def note_written(self):
+        with self.count_lock:
+            self.written += 1
+
+    def note_skipped(self):
+        with self.count_lock:
+            self.skipped += 1
+
+    def write(self, path, data, mtime=None):
+        '''write schedules the bytes data to be written to path.'''
+        self.submit(self._write, path, data, mtime)
+
+    def _write(self, path, data, mtime):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as out:
+            preallocate(out, len(data))
+            out.write(data)
+        if mtime != None:
+            os.utime(path, (mtime, mtime))
+        self.note_written()
+
+
+def extract_zip_file(zip_path, directory, workers=4):
+    '''extract_zip_file extracts the members of the zip file at
+    zip_path into directory using workers threads.'''
+    with zipfile.ZipFile(zip_path, 'r') as zf:
+        with MemberWriter(workers) as writer:
+            for info in zf.infolist():
+                path = member_path(directory, info.filename)
+                if info.is_dir():
+                    os.makedirs(path, exist_ok=True)
+                    continue
+                writer.submit(_extract_zip_member, writer, zf, info, path)
+    return writer
+
+
+def _extract_zip_member(writer, zf, info, path):
+    if already_extracted(path, info.file_size, crc=info.CRC):
+        writer.note_skipped()
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # zipfile serializes access to the underlying file so members can be
+    # read concurrently.
+    with zf.open(info) as input:
+        with open(path, 'wb') as out:
+            preallocate(out, info.file_size)
+            while True:
+                buffer = input.read(CHUNK_SIZE)
+                if len(buffer) == 0:
+                    break
+                out.write(buffer)
+    writer.note_written()
+
+
+class PushbackReader (object):
+    '''PushbackReader reads exactly the requested number of bytes from a
+    stream and allows bytes that were read too far to be pushed back.'''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.pushed = b''
+
+    def unread(self, data):
+        self.pushed = data + self.pushed
+
+    def read_some(self, n):
+        if self.pushed:
+            data, self.pushed = self.pushed[:n], self.pushed[n:]
+            return data
+        return self.stream.read(n)
+
+    def read(self, n):
+        parts = []
+        while n > 0:
+            data = self.read_some(n)
+            if len(data) == 0:
+                raise EOFError('Archive stream ended prematurely')
+            parts.append(data)
+            n -= len(data)
+        return b''.join(parts)
+
+
+ZIP_LOCAL_HEADER = b'PK\x03\x04'
+ZIP_DATA_DESCRIPTOR = b'PK\x07\x08'
+# Any of these after the last member means that there are no more.
+ZIP_TRAILERS = (b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06', b'PK\x06\x07')
+
+ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+ZIP64_EXTRA_ID = 0x0001
+
+
+def zip64_sizes(extra, usize, csize):
+    '''zip64_sizes returns the uncompressed and compressed sizes from a
+    local header's ZIP64 extra field if the header's own are escaped.'''
+    i = 0
+    while i + 4 <= len(extra):
+        header_id, length = struct.unpack('<HH', extra[i:i + 4])
+        if header_id == ZIP64_EXTRA_ID:
+            data = extra[i + 4:i + 4 + length]
+            j = 0
+            if usize == 0xFFFFFFFF:
+                usize = struct.unpack('<Q', data[j:j + 8])[0]
+                j += 8
+            if csize == 0xFFFFFFFF:
+                csize = struct.unpack('<Q', data[j:j + 8])[0]
+            return usize, csize, True
+        i += 4 + length
+    return usize, csize, False
+
+
+def extract_zip_stream(stream, directory, workers=4):
+    '''extract_zip_stream extracts the members of a zip file from
+    stream, which need not be seekable, into directory.  It reads the
+    local header in front of each member rather than the central
+    directory at the end of the file, so extraction can proceed while
+    the zip file is still being downloaded.'''
+    reader = PushbackReader(stream)
+    with MemberWriter(workers) as writer:
+        while True:
+            signature = reader.read(4)
+            if signature in ZIP_TRAILERS:
+                break
+            if signature != ZIP_LOCAL_HEADER:
+                raise Exception('Bad zip local header signature %r' % signature)
+            (version, flags, method, mod_time, mod_date, crc, csize, usize,
+             name_length, extra_length) = struct.unpack(
+                 '<HHHHHIIIHH', reader.read(26))
+            name = reader.read(name_length).decode(
+                'utf-8' if flags & 0x800 else 'cp437')
+            extra = reader.read(extra_length)
+            usize, csize, is_zip64 = zip64_sizes(extra, usize, csize)
+            if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                raise Exception('%s: unsupported compression method %d' % (name, method))
+            path = member_path(directory, name)
+            if flags & ZIP_FLAG_DATA_DESCRIPTOR:
+                # The sizes and CRC follow the data.
+                if method != zipfile.ZIP_DEFLATED:
+                    raise Exception('%s: can\'t find the end of a stored member '
+                                    'of unknown size' % name)
+                data = inflate_to_end(reader)
+                descriptor = reader.read(4)
+                if descriptor != ZIP_DATA_DESCRIPTOR:
+                    # The data descriptor signature is optional.
+                    reader.unread(descriptor)
+                crc = struct.unpack('<I', reader.read(4))[0]
+                reader.read(16 if is_zip64 else 8)
+            else:
+                data = reader.read(csize)
+                if method == zipfile.ZIP_DEFLATED:
+                    data = zlib.decompress(data, -15)
+            if name.endswith('/'):
+                os.makedirs(path, exist_ok=True)
+                continue
+            if zlib.crc32(data) != crc:
+                raise Exception('%s: CRC mismatch' % name)
+            if already_extracted(path, len(data), crc=crc):
+                writer.note_skipped()
+                continue
+            writer.write(path, data)
+    return writer
+
+
+def inflate_to_end(reader):
+    '''inflate_to_end decompresses a deflate stream from reader, leaving
+    reader positioned just after it.'''
+    inflater = zlib.decompressobj(-15)
+    parts = []
+    while not inflater.eof:
+        compressed = reader.read_some(CHUNK_SIZE)
+        if len(compressed) == 0:
+            raise EOFError('Archive stream ended prematurely')
+        parts.append(inflater.decompress(compressed))
+    reader.unread(inflater.unused_data)
+    return b''.join(parts)
+
+
+def extract_tar_stream(stream, directory, workers=4):
+    '''extract_tar_stream extracts the regular files of a tar file, which
+    may be compressed, from stream into directory.  Members which
+    already exist with the same size and modification time are
+    skipped.'''
+    with MemberWriter(workers) as writer:
+        with tarfile.open(fileobj=stream, mode='r|*') as tf:
+            for member in tf:
+                path = member_path(directory, member.name)
+                if member.isdir():
+                    os.makedirs(path, exist_ok=True)
+                    continue
+                if not member.isfile():
+                    continue
+                if already_extracted(path, member.size, mtime=member.mtime):
+                    writer.note_skipped()
+                    continue
+                writer.write(path, tf.extractfile(member).read(), member.mtime)
+    return writer
+
+
+def extract_file(archive_path, format, directory, workers=4):
+    '''extract_file extracts the archive at archive_path, whose
+    archive.org format is format, into directory.'''
+    if format == PROCESSED_ZIP_FORMAT:
+        return extract_zip_file(archive_path, directory, workers)
+    if format == ORIGINAL_TAR_FORMAT:
+        with open(archive_path, 'rb') as stream:
+            return extract_tar_stream(stream, directory, workers)
+    raise Exception('Unsupported archive format %r' % format)
+
+
+def extract_stream(stream, format, directory, workers=4):
+    '''extract_stream extracts an archive whose archive.org format is
+    format from stream into directory.'''
+    if format == PROCESSED_ZIP_FORMAT:
+        return extract_zip_stream(stream, directory, workers)
+    if format == ORIGINAL_TAR_FORMAT:
+        return extract_tar_stream(stream, directory, workers)
+    raise Exception('Unsupported archive format %r' % format)
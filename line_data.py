@@ -1,5 +1,7 @@
 
 import operator
+import weakref
+from array import array
 from functools import reduce
 from region import Region
 # from page import Page
@@ -16,6 +18,11 @@ class LineData (object):
     text.  We hope it can be used to distinguish normal text from page
     headings, page footers, text within images and other text.'''
 
+    # There is a LineData for every line of every page of a book, so
+    # they do without a __dict__.
+    __slots__ = ('page', 'hiddentext_pos', 'pagecolumn_pos', 'region_pos',
+                 'paragraph_pos', 'line_pos', 'region', 'text', 'flags')
+
     def __init__(self, page, hiddentext_pos, pagecolumn_pos,
                  region_pos, paragraph_pos, line_pos, region, text):
         self.page = page
@@ -36,11 +43,16 @@ class LineData (object):
             self.flags |= CHARACTER_FLAGS[c]
 
     @classmethod
-    def for_page(cls, page, page_object=None):
+    def for_page(cls, page, page_object=None, line_regions=None):
+        '''for_page returns a ParaBlock for each PARAGRAPH of page.
+        line_regions, if specified, is the text_bounds of each of the
+        page's LINE elements in order, from the book's OCRGeometry.'''
         # assert isinstance(page, Page)
         parablocks = []
         if page_object == None:
             page_object = page.get_ocr_object_element()
+        if line_regions != None:
+            line_regions = iter(line_regions)
         first_line = None
         last_line = None
         for ht_index, ht in enumerate(page_object.findall('HIDDENTEXT')):
@@ -53,7 +65,8 @@ class LineData (object):
                                 page, ht_index + 1, pc_index + 1,
                                 region_index + 1, para_index + 1,
                                 line_index + 1,
-                                text_bounds(line, page.jp2_region),
+                                (next(line_regions) if line_regions != None
+                                 else text_bounds(line, page.jp2_region)),
                                 ' '.join([w.text for w in line.findall('WORD')])
                             )
                             if first_line == None:
@@ -97,7 +110,7 @@ class LineData (object):
             bit_string(self.flags),
             self.text))
 
-    def same_paragraph(sef, other):
+    def same_paragraph(self, other):
         '''same_paragraph returns true if the lines are in the same paragraph.'''
         return (self.page == other.page and
                 self.hiddentext_pos == other.hiddentext_pos and
@@ -113,23 +126,54 @@ class ParaBlock (object):
     
     Subclasses represent explicitly recognized paragraph roles.'''
 
+    # Subclasses should declare empty __slots__ too.
+    __slots__ = ('line_data',)
+
     def __init__(self, lines):
         self.line_data = lines
 
     # ParaBlock is the default implementation if none of its
     # subclasses test_type methods is satisfied.
     @classmethod
-    def test_type(cls, lines):
-        return cls
+    def test_features(cls, features, i):
+        '''test_features returns True if row i of the ParaFeatures features
+        describes a paragraph of this role.'''
+        return True
 
     @classmethod
-    def find_type(cls, lines):
+    def test_type(cls, lines, features=None):
+        '''test_type returns cls if lines are a paragraph of this role,
+        otherwise None.  features, if given, is the ParaFeatures.for_lines
+        of lines.'''
+        if features == None:
+            features = ParaFeatures.for_lines(lines)
+        if cls.test_features(features, 0):
+            return cls
+        return None
+
+    @classmethod
+    def roles(cls):
+        '''roles returns cls and its subclasses in the order their tests
+        should be tried: each class after its own subclasses, and sibling
+        classes in the order they were defined.'''
+        found = []
         for subclass in cls.__subclasses__():
-            t = subclass.find_type(lines)
+            found.extend(subclass.roles())
+        found.append(cls)
+        return found
+
+    @classmethod
+    def find_type(cls, lines):
+        '''find_type returns the first of cls.roles() whose test_type
+        accepts lines, or None if there is none.  ParaBlock itself
+        accepts any lines.'''
+        features = ParaFeatures.for_lines(lines)
+        for role in cls.roles():
+            t = role.test_type(lines, features)
             if t != None:
                 return t
-        return cls.test_type(lines)
-    
+        return None
+
     def region(self):
         return Region.rectangular_hull(
             [ld.region for ld in self.line_data])
@@ -159,35 +203,206 @@ class ParaBlock (object):
 class PageNumberParaBlock(ParaBlock):
     '''PageNumberParaBlock contains a page number.'''
 
+    __slots__ = ()
+
     @classmethod
-    def test_type(cls, lines):
-        if len(lines) != 1:
-            return None
+    def test_features(cls, features, i):
         # ??? How dowe tell if it's the first or last line in the page?
-        # Does it match the page number
-        line = lines[0]
-        if str(line.page.page_number) != line.text:
-            return None
-        return cls
-    
+        return features.line_count[i] == 1 and features.is_page_number[i]
+
+
+# Running heads and footers are within this fraction of the page
+# height of its top or bottom edge.
+EDGE_RATIO = 0.15
+
+# Nor are their lines more than this many times the height of the
+# lines of the body text.
+BODY_HEIGHT_RATIO = 1.2
+
+
+class RunningHeadParaBlock (ParaBlock):
+    '''RunningHeadParaBlock is a single line at the top of the page, such
+    as a running head.'''
+
+    __slots__ = ()
+
+    @classmethod
+    def test_features(cls, features, i):
+        # Headings and chapter titles are usually set larger than the
+        # body text, and not so close to the edge of the page.
+        return (features.line_count[i] == 1 and
+                bool(features.flags_or[i] & PAGE_FIRST_LINE) and
+                features.bottom_ratio[i] <= EDGE_RATIO and
+                features.no_taller_than_body(i))
+
+
+class FooterParaBlock (ParaBlock):
+    '''FooterParaBlock is a single line at the bottom of the page.'''
+
+    __slots__ = ()
+
+    @classmethod
+    def test_features(cls, features, i):
+        # The last line of a short page isn't near the bottom of it.
+        return (features.line_count[i] == 1 and
+                bool(features.flags_or[i] & PAGE_LAST_LINE) and
+                features.top_ratio[i] >= 1 - EDGE_RATIO and
+                features.no_taller_than_body(i))
+
 
 class BodyTextParaBlock (ParaBlock):
     '''BodyTextParaBlock is a ParaBlock containing normal body text from
     the book.'''
 
+    __slots__ = ()
+
+    @classmethod
+    def test_features(cls, features, i):
+        # The spacing between the tops of consecutive lines is within 5%
+        # of its average.
+        return (features.line_count[i] > 1 and
+                features.spacing_max_deviation[i] <= .05 * features.spacing_mean[i])
+
+
+class ParaFeatures (object):
+    '''ParaFeatures holds, in a column per feature, the features of a
+    sequence of paragraphs, each given as its list of LineData, that
+    the test_features methods of the ParaBlock roles look at.
+
+    body_line_height is the median line height of the body text
+    paragraphs among them.'''
+
+    def __init__(self, paragraphs):
+        self.line_count = array('i')
+        # The spacing between the tops of consecutive lines.
+        self.spacing_mean = array('d')
+        self.spacing_variance = array('d')
+        self.spacing_max_deviation = array('d')
+        self.height_mean = array('d')
+        self.height_max = array('i')
+        # The width of the paragraph as a fraction of that of the page,
+        # and its top and bottom as fractions of the page's height.
+        self.width_ratio = array('d')
+        self.top_ratio = array('d')
+        self.bottom_ratio = array('d')
+        # The union and intersection of the flags of the lines.
+        self.flags_or = array('i')
+        self.flags_and = array('i')
+        # Whether the text of the first line is the page's page number.
+        self.is_page_number = array('b')
+        for lines in paragraphs:
+            self.add(lines)
+        self.body_line_height = self.median_body_line_height()
+
     @classmethod
-    def test_type(cls, lines):
-        if len(lines) <= 1:
+    def for_lines(cls, lines):
+        '''for_lines returns the ParaFeatures of the single paragraph lines,
+        with the body_line_height of the rest of its page.'''
+        features = cls([lines])
+        if len(lines) > 0 and lines[0].page.paras:
+            features.body_line_height = page_body_line_height(lines[0].page)
+        return features
+
+    def __len__(self):
+        return len(self.line_count)
+
+    def median_body_line_height(self):
+        heights = sorted([self.height_mean[i] for i in range(len(self))
+                          if BodyTextParaBlock.test_features(self, i)])
+        if len(heights) == 0:
             return None
-        line_spacings = [ lines[i + 1].region.top - lines[i].region.top
-                          for i in range(len(lines) - 1) ]
-        if len(line_spacings) > 0:
-            average_line_spacing = (reduce(operator.add, line_spacings, 0) /
-                                    len(line_spacings))
-            for s in line_spacings:
-                if abs(s - average_line_spacing) > .05 * average_line_spacing:
-                    return None
-        return cls
+        return heights[len(heights) // 2]
+
+    def no_taller_than_body(self, i):
+        '''no_taller_than_body returns True if the lines of paragraph i are
+        no taller than those of the body text.'''
+        return (self.body_line_height != None and
+                self.height_max[i] <= BODY_HEIGHT_RATIO * self.body_line_height)
+
+    def add(self, lines):
+        n = len(lines)
+        self.line_count.append(n)
+        spacings = [lines[i + 1].region.top - lines[i].region.top
+                    for i in range(n - 1)]
+        if spacings:
+            mean = sum(spacings) / len(spacings)
+            self.spacing_mean.append(mean)
+            self.spacing_variance.append(
+                sum([(s - mean) ** 2 for s in spacings]) / len(spacings))
+            self.spacing_max_deviation.append(
+                max([abs(s - mean) for s in spacings]))
+        else:
+            self.spacing_mean.append(0)
+            self.spacing_variance.append(0)
+            self.spacing_max_deviation.append(0)
+        heights = [line.region.height for line in lines]
+        self.height_mean.append(sum(heights) / n if n else 0)
+        self.height_max.append(max(heights, default=0))
+        flags_or = 0
+        flags_and = -1 if n else 0
+        for line in lines:
+            flags_or |= line.flags
+            flags_and &= line.flags
+        self.flags_or.append(flags_or)
+        self.flags_and.append(flags_and)
+        if n:
+            page = lines[0].page
+            self.width_ratio.append(
+                (max([line.region.right for line in lines]) -
+                 min([line.region.left for line in lines])) /
+                page.jp2_width)
+            self.top_ratio.append(
+                min([line.region.top for line in lines]) / page.jp2_height)
+            self.bottom_ratio.append(
+                max([line.region.bottom for line in lines]) / page.jp2_height)
+            # LineData.text is bytes.
+            self.is_page_number.append(
+                page.page_number != None and
+                lines[0].text.strip() == str(page.page_number).encode('ascii'))
+        else:
+            self.width_ratio.append(0)
+            self.top_ratio.append(0)
+            self.bottom_ratio.append(0)
+            self.is_page_number.append(False)
+
+
+# The body_line_height of each Page, and the paras it was computed
+# from, for ParaFeatures.for_lines.
+_page_body_line_heights = weakref.WeakKeyDictionary()
+
+def page_body_line_height(page):
+    '''page_body_line_height returns the body_line_height of the
+    paragraphs of page.  It is remembered until page.paras is replaced.'''
+    remembered = _page_body_line_heights.get(page)
+    if remembered != None and remembered[0] is page.paras:
+        return remembered[1]
+    height = ParaFeatures([para.line_data for para in page.paras]).body_line_height
+    _page_body_line_heights[page] = (page.paras, height)
+    return height
+
+
+def classify_paragraphs(paras):
+    '''classify_paragraphs determines the role of each of the ParaBlocks
+    in paras, all at once, and records it by making the ParaBlock an
+    instance of the ParaBlock subclass for that role.'''
+    paras = [para for para in paras if len(para.line_data) > 0]
+    features = ParaFeatures([para.line_data for para in paras])
+    remaining = range(len(paras))
+    for role in ParaBlock.roles():
+        unmatched = []
+        for i in remaining:
+            if role.test_features(features, i):
+                paras[i].__class__ = role
+            else:
+                unmatched.append(i)
+        remaining = unmatched
+
+
+def classify_book(book):
+    '''classify_book applies classify_paragraphs to every paragraph of
+    book.'''
+    classify_paragraphs([para for p in book.pages if p.paras
+                         for para in p.paras])
 
 
 def average_top_delta(lines):
@@ -0,0 +1,78 @@
+# Measuring how much memory the analysis of a Book takes.
+#
+# The sizes are those reported by sys.getsizeof for every object
+# reachable from each part of the Book, each object being counted only
+# once, in the first part it is found in.
+
+import sys
+from array import array
+from page import Book, Page
+
+
+def deep_sizeof(obj, seen, stop=(Book, Page)):
+    '''deep_sizeof returns the total size of obj and of the objects
+    reachable from it that are not in seen, a dict which it adds them
+    to keyed by id.  Instances of the classes in stop are not followed.'''
+    total = 0
+    pending = [obj]
+    while pending:
+        o = pending.pop()
+        if id(o) in seen or isinstance(o, type):
+            continue
+        if o is not obj and isinstance(o, stop):
+            continue
+        # Keeping o in seen keeps its id from being reused.
+        seen[id(o)] = o
+        total += sys.getsizeof(o)
+        if isinstance(o, (str, bytes, int, float, array, type(None))):
+            continue
+        if isinstance(o, dict):
+            pending.extend(o.keys())
+            pending.extend(o.values())
+            continue
+        if isinstance(o, (list, tuple, set, frozenset)):
+            pending.extend(o)
+            continue
+        d = getattr(o, '__dict__', None)
+        if d != None:
+            pending.append(d)
+        for cls in type(o).__mro__:
+            for slot in cls.__dict__.get('__slots__', ()):
+                if hasattr(o, slot):
+                    pending.append(getattr(o, slot))
+    return total
+
+
+def book_memory_report(book):
+    '''book_memory_report returns a list of (part, count, bytes) for the
+    parts of book's analysis.'''
+    seen = {}
+    pages = book.pages
+    paras = [para for p in pages if p.paras for para in p.paras]
+    lines = [line for para in paras for line in para.line_data]
+    report = [
+        ('line data', len(lines), deep_sizeof(lines, seen)),
+        ('paragraphs', len(paras), deep_sizeof(paras, seen)),
+        ('picture regions', sum([len(p.picture_regions) for p in pages]),
+         deep_sizeof([p.picture_regions for p in pages], seen)),
+        ('page metadata', len(pages), deep_sizeof([p.metadata for p in pages], seen)),
+        ('pages', len(pages),
+         sum([deep_sizeof(p, seen, stop=(Book,)) for p in pages])),
+        ('text geometry', len(book.geometry.words),
+         deep_sizeof(book.geometry, seen)),
+        ('word sizes', len(book.word_size_collector),
+         deep_sizeof(book.word_size_collector, seen)),
+        ('indexes', len(book.pages_by_sequence_number),
+         deep_sizeof([book.pages_by_sequence_number, book.pages_by_page_number],
+                     seen))
+    ]
+    return report
+
+
+def print_memory_report(book):
+    report = book_memory_report(book)
+    print('Memory used by %s' % book)
+    for part, count, size in report:
+        print('%-16s %8d %12d bytes  %8.1f per item' % (
+            part, count, size, size / count if count else 0))
+    print('%-16s %8s %12d bytes' % ('total', '', sum([r[2] for r in report])))
@@ -0,0 +1,202 @@
+# A compact table of the coordinates of the OCRed text of a book.
+#
+# The coordinates in a djvu XML file are strings that would otherwise
+# be parsed again each time a bounding box is wanted.  OCRGeometry
+# parses them once, as each OBJECT element is read, into columns of
+# integers: one row per WORD, per LINE, per PARAGRAPH and per page.
+# Rows are in document order, and the lines of a paragraph, the words
+# of a line and the paragraphs of a page are found by slicing, using
+# arrays of start offsets in the style of a compressed sparse row
+# matrix.
+#
+# The bounding boxes of lines, paragraphs and pages are unions of the
+# coordinates of their descendants, just as ocr_xml.text_bounds
+# computes them.  Empty boxes have their left and top at MAX_COORD and
+# their right and bottom at MIN_COORD, so clamping to the page, as
+# text_bounds does, gives the same answer for them too.
+
+from array import array
+from region import Region
+from ocr_xml import iterparse_elements
+
+
+MAX_COORD = 2 ** 31 - 1
+MIN_COORD = -2 ** 31
+
+
+def parse_coords(elt):
+    '''parse_coords returns the left, bottom, right, top and baseline right
+    coordinates of an element with a coords attribute.'''
+    return tuple([int(i) for i in elt.attrib['coords'].split(',')])
+
+
+class BoxColumns (object):
+    '''BoxColumns holds the left, top, right and bottom coordinates of a
+    sequence of boxes in four arrays.'''
+
+    def __init__(self):
+        self.left = array('i')
+        self.top = array('i')
+        self.right = array('i')
+        self.bottom = array('i')
+
+    def __len__(self):
+        return len(self.left)
+
+    def append(self, box):
+        left, top, right, bottom = box
+        self.left.append(left)
+        self.top.append(top)
+        self.right.append(right)
+        self.bottom.append(bottom)
+
+    def union(self, start, end):
+        '''union returns the (left, top, right, bottom) of the smallest box
+        that contains the boxes from start up to end.'''
+        if end <= start:
+            return (MAX_COORD, MAX_COORD, MIN_COORD, MIN_COORD)
+        return (min(self.left[start:end]), min(self.top[start:end]),
+                max(self.right[start:end]), max(self.bottom[start:end]))
+
+    def box(self, i):
+        return (self.left[i], self.top[i], self.right[i], self.bottom[i])
+
+
+def union(box1, box2):
+    return (min(box1[0], box2[0]), min(box1[1], box2[1]),
+            max(box1[2], box2[2]), max(box1[3], box2[3]))
+
+
+def clamped_region(box, whole):
+    '''clamped_region returns box as a Region, widened to include the
+    far edges of whole as text_bounds does.'''
+    left, top, right, bottom = box
+    return Region(min(whole.right, left), max(whole.left, right),
+                  min(whole.bottom, top), max(whole.top, bottom))
+
+
+class OCRGeometry (object):
+    '''OCRGeometry is the table of text coordinates for a book.'''
+
+    def __init__(self):
+        self.words = BoxColumns()
+        self.word_baseline_right = array('i')
+        # Each LINE's box is the union of its WORDs.
+        self.lines = BoxColumns()
+        self.line_word_start = array('i', [0])
+        # Each PARAGRAPH's box is the union of the boxes of all of its
+        # descendants with coordinates, the LINEs themselves included.
+        self.paragraphs = BoxColumns()
+        self.paragraph_line_start = array('i', [0])
+        # Likewise each page's box.
+        self.pages = BoxColumns()
+        self.page_paragraph_start = array('i', [0])
+        self.page_sequence_number = array('i')
+        self.page_index = {}
+
+    def add_object(self, obj, sequence_number=None):
+        '''add_object adds the text coordinates of the OBJECT element obj,
+        a page, to the table.  The page is looked up by sequence_number,
+        which defaults to its position in the table.'''
+        if sequence_number == None:
+            sequence_number = len(self.page_sequence_number)
+        empty = (MAX_COORD, MAX_COORD, MIN_COORD, MIN_COORD)
+        # Each element's coordinates are parsed once.
+        boxes = {}
+        page_box = empty
+        for elt in obj.iter():
+            if 'coords' in elt.attrib:
+                left, bottom, right, top, baseline_right = parse_coords(elt)
+                boxes[elt] = (left, top, right, bottom, baseline_right)
+                page_box = union(page_box, (left, top, right, bottom))
+        for para in obj.iter('PARAGRAPH'):
+            para_box = empty
+            for line in para.findall('LINE'):
+                line_box = empty
+                for elt in line.iter():
+                    box = boxes.get(elt)
+                    if box == None:
+                        continue
+                    para_box = union(para_box, box[:4])
+                    if elt is line:
+                        continue
+                    line_box = union(line_box, box[:4])
+                    if elt.tag == 'WORD':
+                        self.words.append(box[:4])
+                        self.word_baseline_right.append(box[4])
+                self.lines.append(line_box)
+                self.line_word_start.append(len(self.words))
+            self.paragraphs.append(para_box)
+            self.paragraph_line_start.append(len(self.lines))
+        self.pages.append(page_box)
+        self.page_paragraph_start.append(len(self.paragraphs))
+        self.page_index[sequence_number] = len(self.page_sequence_number)
+        self.page_sequence_number.append(sequence_number)
+
+    @classmethod
+    def from_djvu(cls, path):
+        '''from_djvu returns the OCRGeometry of the djvu XML file at path.'''
+        geometry = cls()
+        for obj in iterparse_elements(path, 'OBJECT'):
+            geometry.add_object(obj)
+        return geometry
+
+    def __len__(self):
+        return len(self.page_sequence_number)
+
+    def _page(self, sequence_number):
+        return self.page_index.get(sequence_number)
+
+    def page_bounds(self, sequence_number, whole):
+        '''page_bounds returns what text_bounds would for the page's OBJECT
+        element, or None if the page isn't in the table.'''
+        i = self._page(sequence_number)
+        if i == None:
+            return None
+        return clamped_region(self.pages.box(i), whole)
+
+    def paragraph_range(self, sequence_number):
+        '''paragraph_range returns the range of the table's paragraph rows
+        for the page.'''
+        i = self._page(sequence_number)
+        if i == None:
+            return range(0)
+        return range(self.page_paragraph_start[i], self.page_paragraph_start[i + 1])
+
+    def paragraph_bounds(self, sequence_number, whole):
+        '''paragraph_bounds returns what text_bounds would for each of the
+        page's PARAGRAPH elements.'''
+        return [clamped_region(self.paragraphs.box(p), whole)
+                for p in self.paragraph_range(sequence_number)]
+
+    def line_bounds(self, sequence_number, whole):
+        '''line_bounds returns what text_bounds would for each of the
+        LINE elements of the page's paragraphs.'''
+        rows = self.paragraph_range(sequence_number)
+        if len(rows) == 0:
+            return []
+        start = self.paragraph_line_start[rows.start]
+        end = self.paragraph_line_start[rows.stop]
+        return [clamped_region(self.lines.box(l), whole)
+                for l in range(start, end)]
+
+    def text_area(self, sequence_number, whole):
+        '''text_area returns the total area of the rectangular hulls of
+        the lines of each of the page's paragraphs, as Page.text_coverage
+        computes it.'''
+        area = 0
+        for p in self.paragraph_range(sequence_number):
+            start = self.paragraph_line_start[p]
+            end = self.paragraph_line_start[p + 1]
+            if end > start:
+                area += clamped_region(self.lines.union(start, end), whole).area
+        return area
+
+    def word_extent(self):
+        '''word_extent returns the smallest (left, top, right, bottom) that
+        contains all of the words, including their baselines.'''
+        n = len(self.words)
+        if n == 0:
+            return None
+        left, top, right, bottom = self.words.union(0, n)
+        return (left, top, max(right, max(self.word_baseline_right)), bottom)
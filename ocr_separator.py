@@ -4,6 +4,7 @@
 # identify horizontal and vertical ligns in the page image.
 
 from page import whiten
+from region import Region
 
 
 class Separator (object):
@@ -60,6 +61,18 @@ class Separator (object):
         separators.sort()
         return separators
 
+    def region(self):
+        '''region returns the Region covered by the separator, taking its
+        thickness into account.'''
+        left, right = sorted((self.start_x, self.end_x))
+        top, bottom = sorted((self.start_y, self.end_y))
+        thickness = max(1, self.thickness)
+        if self.direction == '-':
+            return Region(left, right, top, top + thickness)
+        if self.direction == '|':
+            return Region(left, left + thickness, top, bottom)
+        return Region(left, right + 1, top, bottom + 1)
+
     def draw(self, image, color = (0x00, 0x00, 0x00)):
         count = 0
         if self.direction == '-':
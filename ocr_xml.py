@@ -1,36 +1,22 @@
 # Analyze the XML file containing the OCR data.
 
+import mmap
+import re
 import xml.etree.ElementTree as ET
+from collections import OrderedDict
 from region import Region
 
 
 def get_page_boundaries(filename):
     '''get_page_boundaries determines page boundaries by looking at the
     coordinates of the extracted text from a djvu XML file.'''
-    tree = ET.parse(filename)
-    # TODO change to use text_bounds()
-    minX = None
-    minY = None
-    maxX = None
-    maxY = None
-    def min(a, b):
-        if a == None:
-            return b
-        if a < b:
-            return a
-        return b
-    def max(a, b):
-        if a == None:
-            return b
-        if a > b:
-            return a
-        return b
-    for word in tree.iter('WORD'):
-        left, bottom, right, top, baseline_right =  tuple([int(i) for i in word.attrib['coords'].split(',')])
-        minX = min(minX, left)
-        minY = min(minY, top)
-        maxX = max(maxX, max(right, baseline_right))
-        maxY = max(maxY, bottom)
+    # Imported here since ocr_geometry depends on this module.
+    from ocr_geometry import OCRGeometry
+    extent = OCRGeometry.from_djvu(filename).word_extent()
+    if extent == None:
+        minX = minY = maxX = maxY = None
+    else:
+        minX, minY, maxX, maxY = extent
     print('X: ', minX, maxX)
     print('Y: ', minY, maxY)
 
@@ -72,3 +58,106 @@ def text_bounds(element, whole):
         if bottom > maxY: maxY = bottom
     return Region(minX, maxX, minY, maxY)
 
+
+
+def iterparse_elements(source, tag, keep=None):
+    '''iterparse_elements parses the XML file source incrementally,
+    yielding each element with the specified tag once it is complete.
+    After the caller is done with an element it is cleared and removed
+    from its parent, so memory use doesn't grow with the size of the
+    file.
+
+    If keep is specified, only elements whose tags are in keep are
+    retained within the yielded elements.  Others are discarded as soon
+    as they are complete.'''
+    ancestors = []
+    for event, elt in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            ancestors.append(elt)
+            continue
+        ancestors.pop()
+        if elt.tag != tag:
+            if keep != None and elt.tag not in keep and ancestors:
+                ancestors[-1].remove(elt)
+            continue
+        yield elt
+        elt.clear()
+        if ancestors:
+            ancestors[-1].remove(elt)
+
+
+OBJECT_REGEXP = re.compile(rb'<OBJECT\b.*?</OBJECT>', re.DOTALL)
+PARAM_REGEXP = re.compile(rb'<PARAM\b[^>]*>')
+ATTRIBUTE_REGEXP = re.compile(rb'(\w+)\s*=\s*"([^"]*)"')
+ENCODING_REGEXP = re.compile(rb'<\?xml[^>]*encoding\s*=\s*["\']([^"\']+)["\']')
+
+
+class DjvuDocument (object):
+    '''DjvuDocument provides access to the OBJECT element for each page
+    of a djvu XML file without parsing the whole file for each page.
+
+    The first time an OBJECT is asked for, the file is scanned to find
+    the byte range of each OBJECT element and the page file named by
+    its PAGE PARAM.  After that, each OBJECT is parsed on its own when
+    it is needed.  The most recently used elements are kept so that
+    the several callers that look at the same page share one parse.'''
+
+    def __init__(self, path, cache_size=8):
+        self.path = path
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.offsets = None
+        self.encoding = None
+
+    def index(self):
+        '''index returns a dict mapping the page file of each OBJECT to
+        the start and end byte offsets of its element.'''
+        if self.offsets != None:
+            return self.offsets
+        offsets = {}
+        with open(self.path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                m = ENCODING_REGEXP.match(mm, 0, 200)
+                if m:
+                    self.encoding = m.group(1).decode('ascii')
+                for m in OBJECT_REGEXP.finditer(mm):
+                    page_file = object_page_file(m.group(0))
+                    if page_file != None:
+                        offsets[page_file] = (m.start(), m.end())
+        self.offsets = offsets
+        return offsets
+
+    def page_files(self):
+        return list(self.index().keys())
+
+    def object_element(self, page_file):
+        '''object_element returns the OBJECT element for page_file, or
+        None if there isn't one.  The element is shared and should not be
+        modified.'''
+        if page_file in self.cache:
+            self.cache.move_to_end(page_file)
+            return self.cache[page_file]
+        extent = self.index().get(page_file)
+        if extent == None:
+            return None
+        with open(self.path, 'rb') as f:
+            f.seek(extent[0])
+            data = f.read(extent[1] - extent[0])
+        if self.encoding:
+            data = (b'<?xml version="1.0" encoding="%s"?>' %
+                    self.encoding.encode('ascii')) + data
+        elt = ET.fromstring(data)
+        self.cache[page_file] = elt
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return elt
+
+
+def object_page_file(object_text):
+    '''object_page_file returns the value of the PAGE PARAM in the text
+    of an OBJECT element.'''
+    for param in PARAM_REGEXP.findall(object_text):
+        attributes = dict(ATTRIBUTE_REGEXP.findall(param))
+        if attributes.get(b'name') == b'PAGE':
+            return attributes.get(b'value', b'').decode('utf-8')
+    return None
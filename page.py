@@ -3,31 +3,53 @@
 import math
 import os
 import os.path
+import pickle
 import re
 import xml.etree.ElementTree as ET
 import operator
+from collections import defaultdict
 from functools import reduce
-from PIL import Image     # pip install Pillow
+from PIL import Image, ImageChops     # pip install Pillow
+import abbyy
+import check_jp2
+import image_cache
 import line_data
 import pnq
+import spill_cache
+import whitespace
 from region import Region
-from ocr_xml import text_bounds
+from ocr_xml import iterparse_elements, DjvuDocument
+from ocr_geometry import OCRGeometry
 from word_size import WordSizeCollector
 
 
 def ranges_overlap(range1, range2):
     return max(range1[0], range2[0]) <= min(range1[-1], range2[-1])
 
-ABBYY_SCHEMA = 'http://www.abbyy.com/FineReader_xml/FineReader10-schema-v1.xml'
+ABBYY_SCHEMA = abbyy.ABBYY_SCHEMA
 
 POINTS_PER_INCH = 72
 
+# The size that Book.make_thumbnails and make_image_highlite_thumbnails
+# fit page images within.
+THUMBNAIL_SIZE = (128, 128)
+
 
 class Book (object):
     '''Book represents a scanned book that was fetched using fetch_pages.py.'''
 
-    def __init__(self, directory):
-        '''directory is the directory that was created by fetch_pages.py.'''
+    # The name of the file in the book's directory where the results of
+    # analyzing the book are saved.
+    SNAPSHOT_FILE = 'book_snapshot.pickle'
+    # This should be incremented whenever a change to the code would
+    # change what is saved, so that old snapshots aren't used.
+    SNAPSHOT_VERSION = 5
+
+    def __init__(self, directory, use_snapshot=True):
+        '''directory is the directory that was created by fetch_pages.py.
+        Unless use_snapshot is false the results of analyzing the book
+        are saved in that directory and reused for as long as the files
+        they were derived from are unchanged.'''
         # assert os.path.isdir(directory)
         # ignore terminal slash.
         if os.path.basename(directory) == '':
@@ -36,6 +58,24 @@ class Book (object):
             self.directory = directory
         self.directory = os.path.abspath(self.directory)
         self.name_token = os.path.basename(self.directory)
+        self.djvu_path = os.path.join(self.directory,
+                                      self.name_token + '_djvu.xml')
+        # The ABBYY file is read directly from the gzipped file that was
+        # downloaded.  Directories from older versions of fetch_pages
+        # might only have the uncompressed copy.
+        self.abbyy_path = os.path.join(self.directory,
+                                       self.name_token + '_abbyy.gz')
+        if not os.path.exists(self.abbyy_path):
+            self.abbyy_path = os.path.join(self.directory,
+                                           self.name_token + '_abbyy.xml')
+        # Shared by all pages for access to their OBJECT elements.
+        self.djvu_document = DjvuDocument(self.djvu_path)
+        # Indexes for page_for_sequence_number and page_for_page_number.
+        self.pages_by_sequence_number = {}
+        self.pages_by_page_number = defaultdict(list)
+        sources = self.source_files()
+        if use_snapshot and self.load_snapshot(sources):
+            return
         self.dc_metadata = DublinCoreMetadata(self)
         self.pages = []
         self.max_page_sequence = 0
@@ -43,40 +83,128 @@ class Book (object):
         for filename in os.listdir(jp2dir):
             p = Page(self, os.path.join(jp2dir, filename))
             self.pages.append(p)
+            self.pages_by_sequence_number[p.sequence_number] = p
             if p.sequence_number > self.max_page_sequence:
                 self.max_page_sequence = p.sequence_number
-        self.djvu_path = os.path.join(self.directory,
-                                      self.name_token + '_djvu.xml')
-        self.abbyy_path = os.path.join(self.directory,
-                                       self.name_token + '_abbyy.xml')
-        djvu_tree = ET.parse(self.djvu_path)
-        for obj in djvu_tree.iter('OBJECT'):
+        # os.listdir returns files in arbitrary order.
+        self.pages.sort(key=lambda p: p.sequence_number)
+        self.word_size_collector = WordSizeCollector()
+        self.read_djvu()
+        self.index_page_numbers()
+        pnq.fix_page_numbers(self)
+        # Page number paragraphs can only be recognized once the page
+        # numbers have been fixed.
+        line_data.classify_book(self)
+        self.read_abbyy()
+        if use_snapshot:
+            self.save_snapshot(sources)
+
+    def snapshot_path(self):
+        return os.path.join(self.directory, self.SNAPSHOT_FILE)
+
+    def source_files(self):
+        '''source_files returns the path, modification time and size of
+        each of the files that the analysis of the book is derived from.'''
+        paths = [self.djvu_path, self.abbyy_path,
+                 os.path.join(self.directory, self.name_token + '_dc.xml')]
+        jp2dir = self.jp2_directory()
+        paths += [os.path.join(jp2dir, f) for f in sorted(os.listdir(jp2dir))]
+        sources = []
+        for path in paths:
+            if os.path.exists(path):
+                st = os.stat(path)
+                sources.append((path, st.st_mtime_ns, st.st_size))
+        return sources
+
+    def load_snapshot(self, sources):
+        '''load_snapshot restores the book's pages and metadata from its
+        snapshot file.  It returns False if there is no usable snapshot
+        for the current source files.'''
+        try:
+            with open(self.snapshot_path(), 'rb') as f:
+                snapshot = pickle.load(f)
+        except Exception:
+            return False
+        if (not isinstance(snapshot, dict) or
+            snapshot.get('version') != self.SNAPSHOT_VERSION or
+            snapshot.get('sources') != sources):
+            return False
+        self.dc_metadata = snapshot['dc_metadata']
+        self.pages = snapshot['pages']
+        self.max_page_sequence = snapshot['max_page_sequence']
+        self.word_size_collector = snapshot['word_size_collector']
+        self.geometry = snapshot['geometry']
+        for p in self.pages:
+            p.book = self
+            self.pages_by_sequence_number[p.sequence_number] = p
+        self.index_page_numbers()
+        return True
+
+    def save_snapshot(self, sources):
+        '''save_snapshot writes the results of analyzing the book to its
+        snapshot file.'''
+        snapshot = {
+            'version': self.SNAPSHOT_VERSION,
+            'sources': sources,
+            'dc_metadata': self.dc_metadata,
+            'pages': self.pages,
+            'max_page_sequence': self.max_page_sequence,
+            'word_size_collector': self.word_size_collector,
+            'geometry': self.geometry
+        }
+        temp = self.snapshot_path() + '.%d' % os.getpid()
+        try:
+            with open(temp, 'wb') as f:
+                pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp, self.snapshot_path())
+        except OSError as e:
+            print('Unable to save %s: %s' % (self.snapshot_path(), e))
+
+    def read_djvu(self):
+        '''read_djvu makes one incremental pass over the djvu XML file,
+        collecting each page's metadata, lines, word sizes and text
+        coordinates.  Each OBJECT element is discarded once it has been
+        processed.'''
+        self.first_sequence_number = None
+        self.geometry = OCRGeometry()
+        for obj in iterparse_elements(self.djvu_path, 'OBJECT'):
             pm = PageMetadata(obj)
             if pm.sequence_number == None:
                 raise Exception('No sequence number: %r', pm)
+            if (self.first_sequence_number == None or
+                pm.sequence_number < self.first_sequence_number):
+                self.first_sequence_number = pm.sequence_number
+            self.geometry.add_object(obj, pm.sequence_number)
             p = self.page_for_sequence_number(pm.sequence_number)
+            # If only selected pages were fetched there won't be a Page
+            # for every OBJECT.
             if p:
                 p.metadata = pm
-                p.paras = line_data.LineData.for_page(p, obj)
-            else:
-                raise Exception('No page %d' % pm.sequence)
-        pnq.fix_page_numbers(self)
-        self.word_size_collector = WordSizeCollector()
-        for word in djvu_tree.iter('WORD'):
-            self.word_size_collector.note_word(word)
-        abbyy_tree = ET.parse(self.abbyy_path)
+                p.paras = line_data.LineData.for_page(
+                    p, obj, self.geometry.line_bounds(pm.sequence_number,
+                                                      p.jp2_region))
+            for word in obj.iter('WORD'):
+                self.word_size_collector.note_word(word)
+
+    def read_abbyy(self):
+        '''read_abbyy makes one incremental pass over the ABBYY XML file,
+        collecting the picture regions of each page.'''
         # There should be a one to one correspondence between page
-        # elements in abbyy_tree and pages of the book.
-        for page, abbyy_page in zip(
-                self.pages,
-                abbyy_tree.iter('{%s}page' % ABBYY_SCHEMA)):
-            for block in abbyy_page.iter('{%s}block' % ABBYY_SCHEMA):
-                if block.attrib.get('blockType') == 'Picture':
-                    def coord(key):
-                        return int(block.attrib[key])
-                    page.picture_regions.append(
-                        Region(coord('l'), coord('r'), coord('t'), coord('b')))
-        
+        # elements in the ABBYY file and the pages of the book in
+        # sequence, whether or not all of the page images were fetched.
+        first = self.first_sequence_number
+        if first == None:
+            first = min([p.sequence_number for p in self.pages], default=0)
+        for index, abbyy_page in abbyy.iter_page_blocks(self.abbyy_path):
+            page = self.page_for_sequence_number(first + index)
+            if page == None:
+                continue
+            for block in abbyy.picture_blocks(abbyy_page):
+                def coord(key):
+                    return int(block.attrib[key])
+                page.picture_regions.append(
+                    Region(coord('l'), coord('r'), coord('t'), coord('b')))
+
     def __str__(self):
         return '<%s.%s %s>' % (
             self.__class__.__module__,
@@ -85,50 +213,69 @@ class Book (object):
 
     def page_for_sequence_number(self, sequence):
         '''page_for_sequence_number finds and returns the Page with the specified sequence number.'''
-        for page in self.pages:
-            if page.sequence_number == sequence:
-                return page
-        return None
+        return self.pages_by_sequence_number.get(sequence)
 
     def page_for_page_number(self, page_number):
-        '''page_for_page_number currently only works with numbered pages.'''
-        for page in self.pages:
-            md = page.metadata
-            if not md:
-                continue
-            if md.page_number == page_number:
-                return page
+        '''page_for_page_number currently only works with numbered pages.
+        If more than one page has the same page number the first is returned.'''
+        pages = self.pages_by_page_number.get(page_number)
+        if pages:
+            return pages[0]
         return None
 
+    def index_page_numbers(self):
+        '''index_page_numbers rebuilds the index used by page_for_page_number.'''
+        self.pages_by_page_number.clear()
+        for page in self.pages:
+            if page.page_number != None:
+                self.pages_by_page_number[page.page_number].append(page)
+
+    def page_number_changed(self, page, old_page_number):
+        '''page_number_changed is called by Page when its page number is
+        changed to keep the page_for_page_number index current.'''
+        if old_page_number != None:
+            pages = self.pages_by_page_number.get(old_page_number)
+            if pages and page in pages:
+                pages.remove(page)
+                if len(pages) == 0:
+                    del self.pages_by_page_number[old_page_number]
+        if page.page_number != None:
+            pages = self.pages_by_page_number[page.page_number]
+            pages.append(page)
+            pages.sort(key=lambda p: p.sequence_number)
+
     def jp2_directory(self):
         return os.path.join(self.directory, 'pages', self.name_token + '_jp2')
 
     def thumbnails_dir(self):
         return os.path.join(self.directory, 'thumbnails')
 
-    def make_thumbnails(self):
-        td = self.thumbnails_dir()
-        try:
-            os.mkdir(td)
-        except OSError:
-            pass
-        for page in self.pages:
-            img = page.load_image()
-            img.thumbnail((128, 128))
-            img.save(page.thumbnail_path(), 'JPEG')
+    def graphics_dir(self):
+        return os.path.join(self.directory, 'graphics')
 
-    def make_image_highlite_thumbnails(self):
-        td = self.thumbnails_dir()
-        try:
-            os.mkdir(td)
-        except OSError:
-            pass
-        for page in self.pages:
-            img = page.image
-            for r in page.picture_regions:
-                hilite_region(img, r)
-            img.thumbnail((128, 128))
-            img.save(page.thumbnail_path('hli'), 'JPEG')        
+    def figures_dir(self):
+        return os.path.join(self.directory, 'figures')
+
+    def decoded_dir(self):
+        return os.path.join(self.directory, 'decoded')
+
+    def make_derivatives(self, outputs, processes=None):
+        '''make_derivatives writes the images in outputs, a sequence of
+        the output kinds defined in the derivatives module, for every
+        page using a pool of processes.  processes defaults to the
+        number of CPUs.'''
+        # derivatives imports this module, so it is imported here rather
+        # than at the top.
+        import derivatives
+        return derivatives.make_derivatives(self, outputs, processes)
+
+    def make_thumbnails(self, processes=None):
+        import derivatives
+        self.make_derivatives((derivatives.THUMBNAIL,), processes)
+
+    def make_image_highlite_thumbnails(self, processes=None):
+        import derivatives
+        self.make_derivatives((derivatives.HIGHLIGHT_THUMBNAIL,), processes)
 
     def list_pages(self):
         print('Book:  %s' % self.name_token)
@@ -178,11 +325,21 @@ class Page (object):
         self.sequence_number = None
         if m:
             self.sequence_number = int(m.group('seq'))
-        # Pillow lazily loads images so it's cheap to open them now.
         # We call load_image each time we need it because many of the
         # operations we might use (like thumbnail) modify the image in
-        # place and we want a 'clean' image each time.
-        self.jp2_width, self.jp2_height = self.image.size
+        # place and we want a 'clean' image each time.  The dimensions
+        # come from the JP2 header so that we needn't open the image
+        # just to learn them.
+        size = check_jp2.image_size(self.jp2filepath)
+        if size == None:
+            size = self.image.size
+        self.jp2_width, self.jp2_height = size
+
+    def __getstate__(self):
+        # The Book is restored by Book.load_snapshot.
+        state = self.__dict__.copy()
+        del state['book']
+        return state
 
     def __str__(self):
         return '<%s.%s %04d>' % (
@@ -190,11 +347,81 @@ class Page (object):
             self.__class__.__name__,
             self.sequence_number)
 
-    def load_image(self):
+    def load_image(self, size=None, reduce=None):
+        '''load_image returns the decoded page image.  If size, a
+        (width, height) tuple, is specified then the image is decoded at
+        the coarsest of the JPEG 2000 resolution levels at which it will
+        still cover size once it is scaled to fit, so it can be shrunk to
+        size more cheaply.  Alternatively reduce can specify the level:
+        the image is decoded at 1/2 to the power of reduce of its full
+        size.'''
         # Since most of the operations on an Image appear to modify it
-        # in place, we don't cache the Image but reopen it when we
-        # need it.
-        return self.image.load()
+        # in place, we don't share the Image but decode it, or copy it
+        # from the image_cache, each time we need it.
+        if reduce == None:
+            reduce = self.reduction_for_size(size) if size != None else 0
+        cache = image_cache.current()
+        if cache != None:
+            return cache.get(self.jp2filepath, reduce, self._decode).copy()
+        return self.decode_image(reduce)
+
+    def shared_image(self, reduce=0):
+        '''shared_image is like load_image except that if the image_cache
+        is enabled the cached Image itself is returned.  It must not be
+        modified.'''
+        cache = image_cache.current()
+        if cache != None:
+            return cache.get(self.jp2filepath, reduce, self._decode)
+        return self.decode_image(reduce)
+
+    def decode_image(self, reduce=0):
+        '''decode_image decodes the page image at 1/2 to the power of
+        reduce of its full size, bypassing the image_cache.  If the
+        spill_cache is enabled the pixels come from the book's spill
+        file instead, but for an RGB page, which is spilled as RGBX, they
+        are copied to make an RGB Image.  See view.'''
+        if spill_cache.enabled():
+            return self.spilled_image(reduce).image()
+        return image_cache.decode(self.jp2filepath, reduce)
+
+    def _decode(self, path, reduce):
+        return self.decode_image(reduce)
+
+    def spilled_image(self, reduce=0):
+        '''spilled_image returns the spill_cache.SpilledImage of the page
+        image, decoding it and writing it to the book's decoded directory
+        first if need be.  Its view and pixels give access to the pixels
+        without copying them.'''
+        return spill_cache.open_spill(self.book.decoded_dir(),
+                                      self.jp2filepath, reduce)
+
+    def view(self, reduce=0):
+        '''view returns a read only Image of the page image whose pixels
+        are those of its spill file, which is written first if need be.
+        The pixels aren't copied, but an RGB page image is an RGBX view.
+        Modifying it, or converting it to RGB, makes a copy.'''
+        return self.spilled_image(reduce).view()
+
+    def reduction_for_size(self, size):
+        '''reduction_for_size returns the reduce argument to load_image
+        for the coarsest resolution level at which the page image would
+        still be at least as big as it is when scaled to fit within size.'''
+        scale = min(size[0] / self.jp2_width, size[1] / self.jp2_height)
+        if scale >= 1:
+            return 0
+        width = self.jp2_width * scale
+        height = self.jp2_height * scale
+        levels = check_jp2.decomposition_levels(self.jp2filepath) or 0
+        reduce = 0
+        # image_cache.decode makes a reduced image reduced_size whether
+        # or not the decoder can decode it at that level itself.
+        while reduce < levels:
+            w, h = image_cache.reduced_size((self.jp2_width, self.jp2_height),
+                                            reduce + 1)
+            if w < width or h < height:
+                break
+            reduce += 1
+        return reduce
 
     @property
     def jp2_region(self):
@@ -202,6 +429,8 @@ class Page (object):
 
     @property
     def image(self):
+        if image_cache.current() != None or spill_cache.enabled():
+            return self.load_image()
         return Image.open(self.jp2filepath)
 
     @property
@@ -214,7 +443,9 @@ class Page (object):
 
     @page_number.setter
     def page_number(self, pn):
+        old = self.page_number
         self.corrected_page_number = pn
+        self.book.page_number_changed(self, old)
 
     @property
     def metadata_width(self):
@@ -232,107 +463,57 @@ class Page (object):
         return os.path.join(self.book.thumbnails_dir(),
                             '%04d%s.jpg' % (self.sequence_number, tag))
 
+    def graphics_path(self):
+        return os.path.join(self.book.graphics_dir(),
+                            '%04d.png' % self.sequence_number)
+
     def get_ocr_object_element(self):
         '''get_ocr_object_element looks for and returns the page's OBJECT
-        element from the book's djvu.xml document. '''
+        element from the book's djvu.xml document.  The element is shared
+        through the book's DjvuDocument and should not be modified.'''
         if not self.metadata:
             return None
-        key = self.metadata.page_file
-        tree = ET.parse(self.book.djvu_path)
-        # tree.find('''.//OBJECT[PARAM/@value='%s']''' % key)
-        # doesn't work.
-        for o in tree.iter('OBJECT'):
-            for p in o.iter('PARAM'):
-                if (p.attrib['name'] == "PAGE" and
-                    p.attrib['value'] == key):
-                    return o
-        return None        
+        return self.book.djvu_document.object_element(self.metadata.page_file)
 
     def text_coverage(self):
         '''What fraction of the total page area has text?'''
-        textarea = 0
-        for para in self.paras:
-            textarea += para.region().area
+        textarea = self.book.geometry.text_area(self.sequence_number,
+                                                self.jp2_region)
         return textarea / (self.metadata_width * self.metadata_height)
 
     def text_region(self):
         '''text_region returns a Region that surrounds all of the OCRed text
         on the page.'''
-        obj = self.get_ocr_object_element()
-        if obj == None:
-            return None
-        return text_bounds(obj, self.jp2_region)
+        return self.book.geometry.page_bounds(self.sequence_number,
+                                              self.jp2_region)
 
     def image_regions(self):
         '''image_regions looks for areas of the page that are not text or
-        margin that might be big enough to fit an image.'''
-        all = self.jp2_region
-        if self.metadata:
-            s = int(round(self.metadata.dpi * 0.25))
-            all = all.inset(s, s, s, s)
-        enough_width = (all.right - all.left) / 4
-        enough_height = (all.bottom - all.top) / 10
-        candidates = []
-        vstart = all.top
-        obj = self.get_ocr_object_element()
-        if not obj:
-            return [all]
-        for p in obj.iter('PARAGRAPH'):
-            r = text_bounds(p, all)
-            if r.top - vstart >= enough_height:
-                candidates.append(Region(all.left, all.right, vstart, r.top))
-            if r.height >= enough_height:
-                if (r.left - all.left) >= enough_width:
-                    candidates.append(Region(all.left, r.left - 1, r.top, r.bottom))
-                if (all.right - r.right) >= enough_width:
-                    candidates.append(Region(r.right + 1, all.right, r.top, r.bottom))
-            vstart = r.bottom + 1
-        if (all.bottom - vstart) >= enough_height:
-            candidates.append(Region(all.left, all.right, vstart, all.bottom))
-        return candidates
+        margin that might be big enough to fit an image.  See
+        whitespace.page_image_regions.'''
+        return whitespace.page_image_regions(self)
 
     def graphics_only(self):
         """graphics_only returns an image of the page with the background
         changed to white and any OCRed text erased."""
-        img = self.image
-        background = self.sample_background()
-        whiten(img, background[0][0], background[1][0], background[2][0])
-        obj = self.get_ocr_object_element()
-        for p in obj.iter('PARAGRAPH'):
-            r = text_bounds(p, self.jp2_region)
-            for y in r.rangeY:
-                for x in r.rangeX:
-                    img.putpixel((x, y), (0xff, 0xff, 0xff))
-        return img
+        return graphics_only_image(self.image, self.background_strip_width(),
+                                   self.paragraph_text_regions())
+
+    def paragraph_text_regions(self):
+        '''paragraph_text_regions returns a Region surrounding the text of
+        each of the page's OCRed paragraphs.'''
+        return self.book.geometry.paragraph_bounds(self.sequence_number,
+                                                   self.jp2_region)
+
+    def background_strip_width(self):
+        '''background_strip_width returns the width in pixels of the strips
+        along the left and right edges of the page image from which
+        sample_background samples the background.'''
+        return int(round(self.metadata.dpi * 0.25))
 
     def sample_background(self):
-        # The page gutter can be too dark to give a good sample, so we
-        # lookat the right 1/4 inch and left 1/4 inch from each edge
-        # and use the background color of the lighter.
-        s = int(round(self.metadata.dpi * 0.25))
-        left = range(0, s)
-        right = range(self.jp2_width - s, self.jp2_width)
-        image = self.image
-        def edge_rgb_ranges(x_range):
-            minR, maxR = 255, 0
-            minG, maxG = 255, 0
-            minB, maxB = 255, 0
-            for y in range(image.size[1]):
-                for x in x_range:
-                    r, g, b = image.getpixel((x, y))
-                    minR = min(minR, r)
-                    maxR = max(maxR, r)
-                    minG = min(minG, g)
-                    maxG = max(maxG, g)
-                    minB = min(minB, b)
-                    maxB = max(maxB, b)
-            return ((minR, maxR), (minG, maxG), (minB, maxB))
-        # White is #xFF.  Greater is lighter.
-        def lightness(rgb_ranges):
-            return reduce(operator.add, [m * m for m in [ r[0] for r in rgb_ranges]])
-        left_rgb = edge_rgb_ranges(left)
-        right_rgb = edge_rgb_ranges(right)
-        return left_rgb if lightness(left_rgb) > lightness(right_rgb) else right_rgb
+        return sample_image_background(self.shared_image(),
+                                       self.background_strip_width())
 
 
 class PageMetadata (object):
@@ -391,42 +572,106 @@ def count_lines(paragraph):
     return len(paragraph.findall('.//LINE'))
 
 
+def threshold_mask(image, thresholds, strict=False):
+    '''threshold_mask returns a mode "L" image that is 0xff where every
+    band of image is at least (or, if strict, greater than) the
+    corresponding element of thresholds and 0 elsewhere.'''
+    mask = None
+    for band, threshold in zip(image.split(), thresholds):
+        if strict:
+            m = band.point(lambda v, t=threshold: 0xff if v > t else 0)
+        else:
+            m = band.point(lambda v, t=threshold: 0xff if v >= t else 0)
+        mask = m if mask == None else ImageChops.darker(mask, m)
+    return mask
+
+
+def sample_image_background(image, s):
+    '''sample_image_background returns the range of each of red, green
+    and blue along the left or right edge of image, whichever is
+    lighter.  s is the width of the edge strips in pixels.'''
+    # The page gutter can be too dark to give a good sample, so we
+    # lookat the right 1/4 inch and left 1/4 inch from each edge
+    # and use the background color of the lighter.
+    def edge_rgb_ranges(left, right):
+        if right <= left:
+            return ((255, 0), (255, 0), (255, 0))
+        return image.crop((left, 0, right, image.size[1])).getextrema()
+    left_rgb = edge_rgb_ranges(0, s)
+    right_rgb = edge_rgb_ranges(image.size[0] - s, image.size[0])
+    return lighter_background(left_rgb, right_rgb)
+
+
+def lighter_background(left_rgb, right_rgb):
+    '''lighter_background returns whichever of the per band color ranges
+    left_rgb and right_rgb has the lighter minimum.'''
+    # White is #xFF.  Greater is lighter.
+    def lightness(rgb_ranges):
+        return reduce(operator.add, [m * m for m in [ r[0] for r in rgb_ranges]])
+    return left_rgb if lightness(left_rgb) > lightness(right_rgb) else right_rgb
+
+
+def graphics_only_image(image, s, text_regions):
+    '''graphics_only_image changes the background of image, as sampled by
+    sample_image_background with edge strips s pixels wide, to white and
+    erases text_regions.  image is modified and returned.'''
+    background = sample_image_background(image, s)
+    whiten(image, background[0][0], background[1][0], background[2][0])
+    erase_regions(image, text_regions)
+    return image
+
+
 def whiten(image, rThreshold, gThreshold, bThreshold):
+    '''whiten changes every pixel of image that is at least as light as
+    the thresholds in each of red, green and blue to white.'''
     assert image.mode == 'RGB'
-    total = 0
-    changed = 0
-    for y in range(image.size[1]):
-        for x in range(image.size[0]):
-            total += 1
-            r, g, b = image.getpixel((x, y))
-            if (r >= rThreshold) and (g >= gThreshold) and (b >= bThreshold):
-                changed += 1
-                image.putpixel((x, y), (0xff, 0xff, 0xff))
+    mask = threshold_mask(image, (rThreshold, gThreshold, bThreshold))
+    image.paste((0xff, 0xff, 0xff), (0, 0) + image.size, mask)
+
+
+def region_box(region):
+    '''region_box returns the box, as PIL expects it, of the pixels in
+    region.rangeX and region.rangeY, or None if there are none.'''
+    if region.right <= region.left or region.bottom <= region.top:
+        return None
+    return (region.left, region.top, region.right, region.bottom)
+
+
+def erase_regions(image, regions):
+    '''erase_regions fills each of regions of image with white.'''
+    for region in regions:
+        box = region_box(region)
+        if box:
+            image.paste((0xff, 0xff, 0xff), box)
 
 
 def outline_region(image, region):
     assert image.mode == 'RGB'
-    for x in region.rangeX:
-        image.putpixel((x, region.top), (0, 0, 0xff))
-        image.putpixel((x, region.bottom), (0, 0, 0xff))
-    for y in region.rangeY:
-        image.putpixel((region.left, y), (0, 0, 0xff))
-        image.putpixel((region.right, y), (0, 0, 0xff))
+    color = (0, 0, 0xff)
+    if region.right > region.left:
+        image.paste(color, (region.left, region.top, region.right, region.top + 1))
+        image.paste(color, (region.left, region.bottom, region.right, region.bottom + 1))
+    if region.bottom > region.top:
+        image.paste(color, (region.left, region.top, region.left + 1, region.bottom))
+        image.paste(color, (region.right, region.top, region.right + 1, region.bottom))
 
 
 def hilite_region(image, region):
+    '''hilite_region changes the pixels within region that are lighter in
+    each of red, green and blue than the darkest values along the
+    region's top row to white.'''
     assert image.mode == 'RGB'
-    rThreshold = 0xff
-    gThreshold = 0xff
-    bThreshold = 0xff
-    for x in region.rangeX:
-        r, g, b = image.getpixel((x, region.top))
-        if r < rThreshold: rThreshold = r
-        if g < gThreshold: gThreshold = g
-        if b < bThreshold: bThreshold = b
-    for y in region.rangeY:
-        for x in region.rangeX:
-            r, g, b = image.getpixel((x, y))
-            if (r > rThreshold) and (g > gThreshold) and (b > bThreshold):
-                image.putpixel((x, y), (0xff, 0xff, 0xff))
+    box = region_box(region)
+    if box == None:
+        return
+    top_row = image.crop((region.left, region.top, region.right, region.top + 1))
+    thresholds = [low for low, high in top_row.getextrema()]
+    mask = threshold_mask(image.crop(box), thresholds, strict=True)
+    image.paste((0xff, 0xff, 0xff), box, mask)
+
+
+def hilite_regions(image, regions):
+    '''hilite_regions applies hilite_region to each of regions in turn.'''
+    for region in regions:
+        hilite_region(image, region)
 
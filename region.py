@@ -1,7 +1,13 @@
 
+import math
+
+
 class Region (object):
     '''Region is used to describe any rectilinear area of a page.'''
 
+    # There are a great many Regions, so they do without a __dict__.
+    __slots__ = ('left', 'right', 'top', 'bottom')
+
     def __init__(self, left, right, top, bottom):
         self.left = left
         self.right = right
@@ -37,6 +43,20 @@ class Region (object):
         return Region(self.left + left, self.right - right,
                       self.top + top, self.bottom - bottom)
 
+    def scale_down(self, divisor):
+        '''scale_down returns the Region that covers self in an image that
+        is smaller than the one self is in by a factor of divisor.'''
+        return Region(self.left // divisor, -(-self.right // divisor),
+                      self.top // divisor, -(-self.bottom // divisor))
+
+    def scaled(self, from_size, to_size):
+        '''scaled returns the Region that covers self, a Region of an image
+        of from_size, in the same image resized to to_size.'''
+        fw, fh = from_size
+        tw, th = to_size
+        return Region(self.left * tw // fw, -(-self.right * tw // fw),
+                      self.top * th // fh, -(-self.bottom * th // fh))
+
     def __repr__(self):
         return('page.Region(%d, %d, %d, %d)' % (
             self.left, self.right, self.top, self.bottom))
@@ -49,37 +69,42 @@ class Region (object):
         return min(abs(self.bottom - other.top),
                    abs(self.top - other.bottom))
 
+    # The ranges_overlap these used to call is defined in page, which
+    # imports this module, so it was never in scope here.
     def overlapsX(self, other):
-        return ranges_overlap(self.rangeX, other.rangeX)
+        return max(self.left, other.left) < min(self.right, other.right)
 
     def overlapsY(self, other):
-        return ranges_overlap(self.rangeY, other.rangeY)
+        return max(self.top, other.top) < min(self.bottom, other.bottom)
+
+    def intersects(self, other):
+        '''intersects returns True if self and other have any pixels in
+        common.'''
+        return self.overlapsX(other) and self.overlapsY(other)
+
+    def contains(self, other):
+        '''contains returns True if other lies entirely within self.'''
+        return (self.left <= other.left and other.right <= self.right and
+                self.top <= other.top and other.bottom <= self.bottom)
+
+    def distance(self, other):
+        '''distance returns the length of the shortest gap between self and
+        other, or 0 if they intersect or touch.'''
+        dx = max(0, other.left - self.right, self.left - other.right)
+        dy = max(0, other.top - self.bottom, self.top - other.bottom)
+        return math.hypot(dx, dy)
 
     @classmethod
     def rectangular_hull(cls, regions):
         '''rectangular_hull returns the smallest Region that contains all of
         the specified regions.'''
-        minX = None
-        minY = None
-        maxX = None
-        maxY = None
-        def min(a, b):
-            if a == None:
-                return b
-            if a < b:
-                return a
-            return b
-        def max(a, b):
-            if a == None:
-                return b
-            if a > b:
-                return a
-            return b
-        for r in regions:
-            minX = min(minX, r.left)
-            minY = min(minY, r.top)
-            maxX = max(maxX, r.right)
-            maxY = max(maxY, r.bottom)
+        regions = list(regions)
+        if len(regions) == 0:
+            return Region(None, None, None, None)
+        minX = min([r.left for r in regions])
+        minY = min([r.top for r in regions])
+        maxX = max([r.right for r in regions])
+        maxY = max([r.bottom for r in regions])
         return Region(minX, maxX, minY, maxY)
 
 
@@ -0,0 +1,210 @@
+# Reading members of a zip file on a web server without downloading
+# the whole thing.
+#
+# A zip file's central directory is at its end, and each member can be
+# located from it.  RemoteFile makes a remote file look like a local
+# seekable one by issuing an HTTP Range request for each read, so
+# zipfile.ZipFile can parse the central directory and extract single
+# members while only the bytes it asks for are transferred.
+# fetch_selected_pages fetches the whole of each run of adjacent
+# members it extracts with one request, rather than one for each chunk
+# that zipfile reads.
+
+import io
+import os
+import os.path
+import re
+import zipfile
+import archive_org
+import page
+
+
+CONTENT_RANGE_REGEXP = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)')
+
+
+class RemoteFile (io.RawIOBase):
+    '''RemoteFile is a read only, seekable file whose content is fetched
+    from url with HTTP Range requests.  opener is as for
+    archive_org.fetch_url_to_file.'''
+
+    # Small reads, like those zipfile makes for headers, are rounded up
+    # to this many bytes and the excess is kept for subsequent reads.
+    MIN_FETCH = 64 * 1024
+
+    def __init__(self, url, opener=archive_org.open_url):
+        self.url = url
+        self.opener = opener
+        self.position = 0
+        self.cache_start = 0
+        self.cache = b''
+        self.size = None
+        self.request_count = 0
+        # The central directory is at the end of a zip file, so the
+        # first request is for the last chunk of the file.  It also
+        # tells us the file's size.
+        self._fetch('-%d' % self.MIN_FETCH)
+
+    def _fetch(self, range):
+        self.request_count += 1
+        with self.opener(self.url, { 'Range': 'bytes=' + range }) as response:
+            if response.status != 206:
+                raise Exception('%s: server does not support Range requests' % self.url)
+            m = CONTENT_RANGE_REGEXP.match(response.getheader('Content-Range', ''))
+            if not m:
+                raise Exception('%s: unexpected Content-Range %r' % (
+                    self.url, response.getheader('Content-Range')))
+            if m.group(3) != '*':
+                self.size = int(m.group(3))
+            data = response.read()
+            # Avoid following the same redirect for every read.
+            self.url = getattr(response, 'url', None) or self.url
+        self.cache_start = int(m.group(1))
+        self.cache = data
+        return data
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self.position = offset
+        elif whence == os.SEEK_CUR:
+            self.position += offset
+        elif whence == os.SEEK_END:
+            self.position = self.size + offset
+        return self.position
+
+    def readinto(self, buffer):
+        count = min(len(buffer), self.size - self.position)
+        if count <= 0:
+            return 0
+        done = 0
+        while done < count:
+            position = self.position + done
+            offset = position - self.cache_start
+            if offset < 0 or offset >= len(self.cache):
+                self._fetch('%d-%d' % (position,
+                                       position + max(count - done, self.MIN_FETCH) - 1))
+                offset = position - self.cache_start
+                # A short response is fetched again from where it ended,
+                # but one with nothing we asked for is an error.
+                if offset < 0 or offset >= len(self.cache):
+                    raise Exception('%s: no data at offset %d' % (self.url, position))
+            n = min(count - done, len(self.cache) - offset)
+            buffer[done:done + n] = self.cache[offset:offset + n]
+            done += n
+        self.position += count
+        return count
+
+    def prefetch(self, start, end):
+        '''prefetch fetches the bytes from start up to end with a single
+        request so that reads within them need none.'''
+        end = min(end, self.size)
+        if start >= self.cache_start and end <= self.cache_start + len(self.cache):
+            return
+        self._fetch('%d-%d' % (start, end - 1))
+
+
+# The size of a zip file local file header without its file name and
+# extra field.
+LOCAL_HEADER_SIZE = 30
+
+# The local extra field can differ from the central directory's, so
+# this much more is fetched in case it is longer.
+LOCAL_EXTRA_SLACK = 1024
+
+# Adjacent members are fetched together so long as the combined request
+# is no larger than this.
+MAX_PREFETCH = 64 << 20
+
+
+def member_span(info):
+    '''member_span returns the start and end offsets, within the zip file,
+    of the member described by the ZipInfo info, including its local
+    header.'''
+    start = info.header_offset
+    return (start,
+            start + LOCAL_HEADER_SIZE + len(info.orig_filename.encode('utf-8')) +
+            len(info.extra) + LOCAL_EXTRA_SLACK + info.compress_size)
+
+
+def merged_spans(infos, max_size=MAX_PREFETCH):
+    '''merged_spans returns the member_spans of infos, in order of offset,
+    with those that overlap or abut merged while they total no more than
+    max_size.'''
+    spans = []
+    for start, end in sorted([member_span(info) for info in infos]):
+        if spans and start <= spans[-1][1] and end - spans[-1][0] <= max_size:
+            spans[-1] = (spans[-1][0], max(end, spans[-1][1]))
+        else:
+            spans.append((start, end))
+    return spans
+
+
+def open_remote_zip(url, opener=archive_org.open_url):
+    '''open_remote_zip returns a zipfile.ZipFile for the zip file at url.'''
+    return zipfile.ZipFile(RemoteFile(url, opener), 'r')
+
+
+def jp2_members(zf):
+    '''jp2_members returns the ZipInfos of the JP2 files of the zip file
+    zf, sorted by page sequence number.'''
+    members = []
+    for info in zf.infolist():
+        seq = page.extract_sequence_number(page.SEQUENCE_NUMBER_JP2_REGEXP,
+                                           info.filename)
+        if seq != None:
+            members.append((seq, info))
+    members.sort(key=lambda m: m[0])
+    return [info for seq, info in members]
+
+
+def fetch_selected_pages(url, target_directory, sequence_numbers=None,
+                         page_indexes=None, opener=archive_org.open_url):
+    '''fetch_selected_pages extracts page images from the "Single Page
+    Processed JP2 ZIP" at url into the pages subdirectory of the book
+    directory target_directory, where page.Book expects to find them.
+
+    Pages can be selected by sequence_numbers, the numbers that appear
+    in the JP2 file names, or by page_indexes, the (0 based) positions
+    of the pages in the book as ABBYY numbers them.  Pages that have
+    already been extracted are skipped.  The paths of the selected page
+    images are returned.'''
+    pages_dir = os.path.join(target_directory, 'pages')
+    written = []
+    remote = RemoteFile(url, opener)
+    with zipfile.ZipFile(remote, 'r') as zf:
+        members = jp2_members(zf)
+        selected = set()
+        if page_indexes != None:
+            selected.update([i for i in page_indexes if i < len(members)])
+        if sequence_numbers != None:
+            selected.update([i for i, info in enumerate(members)
+                             if page.extract_sequence_number(
+                                     page.SEQUENCE_NUMBER_JP2_REGEXP,
+                                     info.filename) in sequence_numbers])
+        wanted = []
+        for info in [members[i] for i in sorted(selected)]:
+            path = os.path.join(pages_dir, info.filename)
+            if not (os.path.isfile(path) and
+                    os.path.getsize(path) == info.file_size):
+                wanted.append(info)
+            written.append(path)
+        # zipfile reads a member in small chunks.  Fetching each run of
+        # adjacent members in one request first means those reads need
+        # no requests of their own.
+        spans = merged_spans(wanted)
+        for info in sorted(wanted, key=lambda info: info.header_offset):
+            start, end = member_span(info)
+            for span in spans:
+                if span[0] <= start and end <= span[1]:
+                    remote.prefetch(*span)
+                    break
+            zf.extract(info, path=pages_dir)
+    return written
@@ -0,0 +1,192 @@
+# Finding the things on a page that are in or near a given area.
+#
+# A SpatialIndex divides a page into a uniform grid of square cells and
+# records which cells each indexed Region touches.  A query only has
+# to look at the entries in the cells its own Region touches, rather
+# than at everything on the page, and a k nearest query looks at rings
+# of cells of increasing distance until nothing nearer can remain.
+#
+# page_index indexes the OCRed lines, the paragraphs, the pictures that
+# ABBYY found and the djvu separators of a Page.
+
+import heapq
+import math
+from collections import defaultdict, namedtuple
+from region import Region
+from ocr_separator import Separator
+
+
+# The kinds of entries page_index makes.
+LINE = 'line'
+PARAGRAPH = 'paragraph'
+PICTURE = 'picture'
+SEPARATOR = 'separator'
+
+
+# region is the entry's Region, kind is a string that queries can
+# select by and item is the thing that it is the Region of.
+Entry = namedtuple('Entry', ('region', 'kind', 'item'))
+
+
+class SpatialIndex (object):
+    '''SpatialIndex is a uniform grid over a set of Entries.  Once it has
+    been made no more entries can be added.'''
+
+    def __init__(self, entries, cell_size=None):
+        self.entries = [e for e in entries if e.region.width > 0 and e.region.height > 0]
+        if len(self.entries) == 0:
+            self.bounds = Region(0, 1, 0, 1)
+        else:
+            self.bounds = Region.rectangular_hull([e.region for e in self.entries])
+        if cell_size == None:
+            # About one entry per cell.
+            cell_size = math.sqrt(self.bounds.area / max(1, len(self.entries)))
+        self.cell_size = max(1, int(cell_size))
+        self.cells = defaultdict(list)
+        for i, e in enumerate(self.entries):
+            for cell in self._cells(e.region):
+                self.cells[cell].append(i)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _cell_range(self, region):
+        c = self.cell_size
+        return (region.left // c, (region.right - 1) // c,
+                region.top // c, (region.bottom - 1) // c)
+
+    def _cells(self, region):
+        x0, x1, y0, y1 = self._cell_range(region)
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                yield (x, y)
+
+    def _candidates(self, region):
+        x0, x1, y0, y1 = self._cell_range(region)
+        # Don't look at cells outside of the grid.
+        bx0, bx1, by0, by1 = self._cell_range(self.bounds)
+        found = set()
+        for x in range(max(x0, bx0), min(x1, bx1) + 1):
+            for y in range(max(y0, by0), min(y1, by1) + 1):
+                found.update(self.cells.get((x, y), ()))
+        return [self.entries[i] for i in sorted(found)]
+
+    def intersecting(self, region, kinds=None):
+        '''intersecting returns the entries, of the specified kinds if
+        kinds is given, whose regions intersect region.'''
+        return [e for e in self._candidates(region)
+                if (kinds == None or e.kind in kinds) and e.region.intersects(region)]
+
+    def contained_in(self, region, kinds=None):
+        '''contained_in returns the entries whose regions lie within region.'''
+        return [e for e in self._candidates(region)
+                if (kinds == None or e.kind in kinds) and region.contains(e.region)]
+
+    def containing(self, region, kinds=None):
+        '''containing returns the entries whose regions contain region.'''
+        return [e for e in self._candidates(region)
+                if (kinds == None or e.kind in kinds) and e.region.contains(region)]
+
+    def nearest(self, region, k=1, kinds=None, exclude=None):
+        '''nearest returns up to k (distance, entry) pairs for the entries
+        nearest region, nearest first.  Entries that intersect region are
+        at distance 0.  exclude, if given, is a function of an entry that
+        returns True for entries that should not be considered.'''
+        if len(self.entries) == 0 or k <= 0:
+            return []
+        x0, x1, y0, y1 = self._cell_range(region)
+        bx0, bx1, by0, by1 = self._cell_range(self.bounds)
+        # The largest ring that could have any cells within the grid.
+        max_ring = max(x0 - bx0, bx1 - x1, y0 - by0, by1 - y1, 0)
+        seen = set()
+        # A heap of the best k as (-distance, -index, entry).
+        best = []
+        for ring in range(max_ring + 1):
+            if ring == 0:
+                cells = self._cells(region)
+            else:
+                cells = self._ring(x0 - ring, x1 + ring, y0 - ring, y1 + ring)
+            for cell in cells:
+                for i in self.cells.get(cell, ()):
+                    if i in seen:
+                        continue
+                    seen.add(i)
+                    e = self.entries[i]
+                    if kinds != None and e.kind not in kinds:
+                        continue
+                    if exclude != None and exclude(e):
+                        continue
+                    item = (-region.distance(e.region), -i, e)
+                    if len(best) < k:
+                        heapq.heappush(best, item)
+                    elif item > best[0]:
+                        heapq.heapreplace(best, item)
+            # Anything in a cell beyond this ring is at least ring cells
+            # away, and might touch region if ring is 0.
+            if len(best) == k and -best[0][0] < ring * self.cell_size:
+                break
+        return [(-d, e) for d, i, e in sorted(best, reverse=True)]
+
+    @staticmethod
+    def _ring(x0, x1, y0, y1):
+        '''_ring yields the cells on the boundary of the rectangle of
+        cells from (x0, y0) to (x1, y1) inclusive.'''
+        for x in range(x0, x1 + 1):
+            yield (x, y0)
+            if y1 != y0:
+                yield (x, y1)
+        for y in range(y0 + 1, y1):
+            yield (x0, y)
+            if x1 != x0:
+                yield (x1, y)
+
+
+def page_entries(page):
+    '''page_entries returns an Entry for each OCRed line, paragraph,
+    picture and separator of page.'''
+    entries = []
+    for para in page.paras or []:
+        if len(para.line_data) == 0:
+            continue
+        entries.append(Entry(para.region(), PARAGRAPH, para))
+        for line in para.line_data:
+            entries.append(Entry(line.region, LINE, line))
+    for r in page.picture_regions:
+        entries.append(Entry(r, PICTURE, r))
+    if page.get_ocr_object_element() != None:
+        for s in Separator.page_separators(page):
+            entries.append(Entry(s.region(), SEPARATOR, s))
+    return entries
+
+
+def page_index(page, cell_size=None):
+    '''page_index returns a SpatialIndex of page's lines, paragraphs,
+    pictures and separators.'''
+    return SpatialIndex(page_entries(page), cell_size)
+
+
+def book_indexes(book):
+    '''book_indexes returns a dict mapping the sequence number of each
+    page of book to its page_index.'''
+    return dict([(p.sequence_number, page_index(p)) for p in book.pages])
+
+
+def picture_text_overlaps(page, index=None):
+    '''picture_text_overlaps returns a list of (picture region, lines)
+    pairs, where lines are the OCRed lines of page that intersect the
+    picture region.'''
+    if index is None:
+        index = page_index(page)
+    return [(r, [e.item for e in index.intersecting(r, (LINE,))])
+            for r in page.picture_regions]
+
+
+def caption_lines(page, picture_region, k=3, index=None):
+    '''caption_lines returns the k OCRed lines of page nearest to, but
+    not overlapping, picture_region, nearest first.  These are the most
+    likely to be its caption.'''
+    if index is None:
+        index = page_index(page)
+    return [e.item for d, e in index.nearest(
+        picture_region, k, (LINE,),
+        exclude=lambda e: e.region.intersects(picture_region))]
@@ -0,0 +1,236 @@
+# Saving decoded page images to disk as uncompressed pixels.
+#
+# When the spill cache is enabled, with spill_cache.enable, the first
+# time a page image is decoded its pixels are written to a raw file in
+# the book's "decoded" directory, next to "pages".  Later, in the same
+# process or any other, the file is memory mapped rather than the JP2
+# file decoded again.  Pages are then shared through the operating
+# system's page cache by every process that looks at them.
+#
+# A raw file starts with a fixed size header that records the image's
+# mode and size and the modification time and size of the JP2 file it
+# was decoded from, so that it is decoded again if that changes.  RGB
+# pixels are stored four bytes to a pixel because that is how Pillow
+# holds them in memory, which lets an RGBX Image be made directly on top
+# of the mapped file without copying.
+#
+# Each open SpilledImage holds a file descriptor, so only the
+# MAX_OPEN most recently used are kept open.
+
+import mmap
+import os
+import os.path
+import struct
+from collections import OrderedDict
+from PIL import Image
+import image_cache
+
+
+MAGIC = b'LTRAWIMG'
+
+# magic, mode, raw mode, width, height, source modification time,
+# source size, reduce.
+HEADER = struct.Struct('<8s8s8sIIqqI')
+HEADER_SIZE = 64
+
+# The raw mode each mode is stored in, and its bytes per pixel.
+# Image.frombuffer maps the RGBX, RGBA, CMYK and L raw modes without
+# copying.  It copies I and F images.
+RAW_MODES = {
+    'RGB': ('RGBX', 4),
+    'RGBA': ('RGBA', 4),
+    'CMYK': ('CMYK', 4),
+    'L': ('L', 1),
+    'I': ('I', 4),
+    'F': ('F', 4)
+}
+
+
+class SpilledImage (object):
+    '''SpilledImage is a memory mapped raw image file.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.map = self._map_file()
+        try:
+            self._read_header()
+        except Exception:
+            self.map.close()
+            raise
+
+    def _map_file(self):
+        with open(self.path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def mapped(self):
+        '''mapped returns the mmap of the file, mapping it again if it has
+        been closed.'''
+        if self.map.closed:
+            self.map = self._map_file()
+        return self.map
+
+    def _read_header(self):
+        path = self.path
+        (magic, mode, raw_mode, width, height, self.source_mtime_ns,
+         self.source_size, self.reduce) = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise Exception('%s is not a raw image file' % path)
+        self.mode = mode.rstrip(b'\0').decode('ascii')
+        self.raw_mode = raw_mode.rstrip(b'\0').decode('ascii')
+        self.size = (width, height)
+        self.bytes_per_pixel = RAW_MODES[self.mode][1]
+        if len(self.map) != HEADER_SIZE + width * height * self.bytes_per_pixel:
+            raise Exception('%s is truncated' % path)
+
+    def close(self):
+        '''close unmaps the file.  If Images or memoryviews of it are
+        still in use it stays mapped until they are garbage collected.
+        It is mapped again if it is used after being closed.'''
+        try:
+            self.map.close()
+        except BufferError:
+            pass
+
+    def is_current(self, source_stat, reduce):
+        return (self.source_mtime_ns == source_stat.st_mtime_ns and
+                self.source_size == source_stat.st_size and
+                self.reduce == reduce)
+
+    @property
+    def pixels(self):
+        '''pixels is a read only memoryview of the pixel data with the
+        shape (height, width, bytes per pixel).  numpy.asarray can make
+        an array of it without copying.'''
+        width, height = self.size
+        return memoryview(self.mapped())[HEADER_SIZE:].cast(
+            'B', (height, width, self.bytes_per_pixel))
+
+    def view(self):
+        '''view returns a read only Image in the raw mode, RGBX for an RGB
+        image, whose pixels are the mapped file.  This is the only way to
+        get an Image without copying the pixels, except for I and F
+        images, which Image.frombuffer always copies.  Pillow copies it
+        if it is modified.'''
+        return Image.frombuffer(self.raw_mode, self.size,
+                                memoryview(self.mapped())[HEADER_SIZE:],
+                                'raw', self.raw_mode, 0, 1)
+
+    def band(self, top, bottom):
+        '''band returns a read only Image, like view, of just the rows
+        from top up to bottom.'''
+        width = self.size[0]
+        row = width * self.bytes_per_pixel
+        return Image.frombuffer(self.raw_mode, (width, bottom - top),
+                                memoryview(self.mapped())[HEADER_SIZE + top * row:
+                                                     HEADER_SIZE + bottom * row],
+                                'raw', self.raw_mode, 0, 1)
+
+    def image(self):
+        '''image returns the Image in its original mode.  It is a view
+        if the raw mode is the same.  Otherwise, as for RGB images, it is
+        a copy.'''
+        view = self.view()
+        if self.raw_mode == self.mode:
+            return view
+        return view.convert(self.mode)
+
+
+def spill_path(directory, jp2filepath, reduce=0):
+    name = os.path.splitext(os.path.basename(jp2filepath))[0]
+    return os.path.join(directory, '%s.%d.raw' % (name, reduce))
+
+
+def write_spill(path, img, source_stat, reduce):
+    '''write_spill writes the decoded Image img to the raw file at path.'''
+    if img.mode not in RAW_MODES:
+        img = img.convert('RGB')
+    raw_mode = RAW_MODES[img.mode][0]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = path + '.%d' % os.getpid()
+    with open(temp, 'wb') as f:
+        header = HEADER.pack(MAGIC, img.mode.encode('ascii'),
+                             raw_mode.encode('ascii'),
+                             img.size[0], img.size[1],
+                             source_stat.st_mtime_ns, source_stat.st_size,
+                             reduce)
+        f.write(header.ljust(HEADER_SIZE, b'\0'))
+        f.write(img.tobytes('raw', raw_mode))
+    os.replace(temp, path)
+
+
+# The most SpilledImages open_spill and current_spill keep open.
+MAX_OPEN = 8
+
+# The SpilledImages this process has open, keyed by path, least
+# recently used first.
+_open = OrderedDict()
+
+def _remember(path, spilled):
+    old = _open.pop(path, None)
+    if old != None and old is not spilled:
+        old.close()
+    _open[path] = spilled
+    while len(_open) > MAX_OPEN:
+        _open.popitem(last=False)[1].close()
+
+def _current(path, source_stat, reduce):
+    '''_current returns the open or existing SpilledImage at path if it is
+    current, otherwise None.'''
+    spilled = _open.get(path)
+    if spilled == None:
+        try:
+            spilled = SpilledImage(path)
+        except Exception:
+            return None
+    if not spilled.is_current(source_stat, reduce):
+        _open.pop(path, None)
+        spilled.close()
+        return None
+    _remember(path, spilled)
+    return spilled
+
+
+def current_spill(directory, jp2filepath, reduce=0):
+    '''current_spill is like open_spill except that it returns None
+    rather than decoding the JP2 file if there is no current spill file.'''
+    path = spill_path(directory, jp2filepath, reduce)
+    if path not in _open and not os.path.exists(path):
+        return None
+    return _current(path, os.stat(jp2filepath), reduce)
+
+
+def open_spill(directory, jp2filepath, reduce=0):
+    '''open_spill returns the SpilledImage in directory for the JP2 file
+    at jp2filepath, reduced in size by 2 to the power of reduce.  If
+    there isn't a current one the JP2 file is decoded to make it.'''
+    path = spill_path(directory, jp2filepath, reduce)
+    st = os.stat(jp2filepath)
+    spilled = _current(path, st, reduce)
+    if spilled == None:
+        write_spill(path, image_cache.decode(jp2filepath, reduce), st, reduce)
+        spilled = SpilledImage(path)
+        _remember(path, spilled)
+    return spilled
+
+
+def close_all():
+    '''close_all closes all of the SpilledImages that are open.'''
+    while _open:
+        _open.popitem()[1].close()
+
+
+_enabled = False
+
+def enable():
+    '''enable makes Page read decoded page images from, and save them to,
+    the spill cache.'''
+    global _enabled
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+    close_all()
+
+def enabled():
+    return _enabled
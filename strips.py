@@ -0,0 +1,192 @@
+# Processing page images a horizontal band at a time.
+#
+# Some scans include foldout plates whose decoded page image is bigger
+# than we can afford to hold in memory.  The functions here do what
+# Page.sample_background and Page.graphics_only do, with the same
+# results, but only ever have one band of rows of the image in memory,
+# and write their output as they go.
+#
+# The bands come from the page's spill file if it has one, otherwise
+# from glymur, which decodes only the part of the JP2 codestream that
+# covers each band.  glymur isn't otherwise needed, so it has to be
+# installed separately (pip install glymur).  Failing both, memory use
+# would grow with the size of the page, so the functions here refuse
+# unless they are told that the page may be decoded whole, in which
+# case it is spilled if the spill cache is enabled and then processed
+# in bands.
+
+import os
+import os.path
+from PIL import Image
+import page
+import spill_cache
+from region import Region
+
+try:
+    import glymur     # pip install glymur
+except ImportError:
+    glymur = None
+
+
+# The default limit on the size of the pixel data of a band.
+BAND_BYTES = 16 << 20
+
+
+class BandSource (object):
+    '''BandSource provides the rows of a page image a band at a time.
+    This default implementation decodes the whole image.'''
+
+    def __init__(self, p):
+        self.page = p
+        self.size = (p.jp2_width, p.jp2_height)
+        self.img = None
+
+    def band(self, top, bottom):
+        '''band returns an RGB Image of rows top up to bottom.'''
+        if self.img == None:
+            self.img = self.page.shared_image()
+            self.size = self.img.size
+        return self.img.crop((0, top, self.size[0], bottom)).convert('RGB')
+
+    def area(self, left, top, right, bottom):
+        '''area returns an RGB Image of just the columns from left up to
+        right of the rows from top up to bottom.'''
+        return self.band(top, bottom).crop((left, 0, right, bottom - top))
+
+    def row_ranges(self, max_bytes=BAND_BYTES):
+        '''row_ranges yields the top and bottom rows of each band in turn.
+        Each band's pixel data are at most max_bytes.'''
+        rows = max(1, max_bytes // (self.size[0] * 4))
+        for top in range(0, self.size[1], rows):
+            yield top, min(top + rows, self.size[1])
+
+    def bands(self, max_bytes=BAND_BYTES):
+        '''bands yields the top row and the Image of each band in turn.'''
+        for top, bottom in self.row_ranges(max_bytes):
+            yield top, self.band(top, bottom)
+
+
+class SpilledBandSource (BandSource):
+    '''SpilledBandSource reads bands from a spill_cache.SpilledImage
+    without decoding the page again.'''
+
+    def __init__(self, p, spilled):
+        super().__init__(p)
+        self.spilled = spilled
+        self.size = spilled.size
+
+    def band(self, top, bottom):
+        return self.spilled.band(top, bottom).convert('RGB')
+
+
+class GlymurBandSource (BandSource):
+    '''GlymurBandSource decodes each band from just the part of the JP2
+    codestream that covers it.'''
+
+    def __init__(self, p):
+        super().__init__(p)
+        self.jp2 = glymur.Jp2k(p.jp2filepath)
+        self.size = (self.jp2.shape[1], self.jp2.shape[0])
+
+    def band(self, top, bottom):
+        return Image.fromarray(self.jp2[top:bottom, :]).convert('RGB')
+
+    def area(self, left, top, right, bottom):
+        return Image.fromarray(self.jp2[top:bottom, left:right]).convert('RGB')
+
+
+def band_source(p, full_decode=False):
+    '''band_source returns the best BandSource for the Page p.  If there
+    is neither a spill file nor glymur to read bands from, an exception
+    is raised unless full_decode is true.'''
+    spilled = spill_cache.current_spill(p.book.decoded_dir(), p.jp2filepath)
+    if spilled != None:
+        return SpilledBandSource(p, spilled)
+    if glymur != None:
+        return GlymurBandSource(p)
+    if not full_decode:
+        raise Exception('%s: processing a page in bands needs glymur '
+                        '(pip install glymur) or a spill file; with '
+                        'full_decode the whole page is decoded instead' %
+                        p.jp2filepath)
+    if spill_cache.enabled():
+        return SpilledBandSource(p, p.spilled_image())
+    return BandSource(p)
+
+
+def sample_background(p, source=None, max_bytes=BAND_BYTES):
+    '''sample_background returns what Page.sample_background does for the
+    Page p, a band at a time.'''
+    source = source or band_source(p)
+    s = p.background_strip_width()
+    width = source.size[0]
+    empty = ((255, 0), (255, 0), (255, 0))
+    def edge_rgb_ranges(left, top, right, bottom):
+        if right <= left:
+            return empty
+        return source.area(left, top, right, bottom).getextrema()
+    def merge(ranges1, ranges2):
+        return tuple((min(r1[0], r2[0]), max(r1[1], r2[1]))
+                     for r1, r2 in zip(ranges1, ranges2))
+    left = right = empty
+    # Only the edge strips are needed.
+    for top, bottom in source.row_ranges(max_bytes):
+        left = merge(left, edge_rgb_ranges(0, top, s, bottom))
+        right = merge(right, edge_rgb_ranges(width - s, top, width, bottom))
+    return page.lighter_background(left, right)
+
+
+def band_regions(regions, top, bottom):
+    '''band_regions returns regions translated to the coordinates of the
+    band of rows from top up to bottom, leaving out those that don't
+    overlap it.'''
+    return [Region(r.left, r.right, max(r.top, top) - top, min(r.bottom, bottom) - top)
+            for r in regions
+            if r.top < bottom and r.bottom > top]
+
+
+def graphics_only_bands(p, source=None, max_bytes=BAND_BYTES):
+    '''graphics_only_bands yields the top row and Image of each band of
+    what Page.graphics_only would return for the Page p.'''
+    source = source or band_source(p)
+    background = sample_background(p, source, max_bytes)
+    text_regions = p.paragraph_text_regions()
+    for top, band in source.bands(max_bytes):
+        page.whiten(band, background[0][0], background[1][0], background[2][0])
+        page.erase_regions(band, band_regions(text_regions, top, top + band.size[1]))
+        yield top, band
+
+
+def write_ppm(path, size, bands):
+    '''write_ppm writes an RGB image of size, whose rows are provided by
+    bands, an iterable of (top, Image) pairs, to path as a binary PPM
+    file.'''
+    temp = path + '.%d' % os.getpid()
+    with open(temp, 'wb') as f:
+        f.write(b'P6\n%d %d\n255\n' % size)
+        for top, band in bands:
+            f.write(band.tobytes())
+    os.replace(temp, path)
+
+
+def write_graphics_only(p, path, max_bytes=BAND_BYTES, full_decode=False):
+    '''write_graphics_only writes the graphics only image of the Page p,
+    as a binary PPM file, to path without ever holding more than a band
+    of it in memory.  See band_source for full_decode.'''
+    source = band_source(p, full_decode)
+    write_ppm(path, source.size, graphics_only_bands(p, source, max_bytes))
+    return path
+
+
+def whiten_file(p, path, rThreshold, gThreshold, bThreshold,
+                max_bytes=BAND_BYTES, full_decode=False):
+    '''whiten_file writes the image of the Page p, with the pixels that
+    whiten would change made white, to path as a binary PPM file a band
+    at a time.  See band_source for full_decode.'''
+    source = band_source(p, full_decode)
+    def whitened():
+        for top, band in source.bands(max_bytes):
+            page.whiten(band, rThreshold, gThreshold, bThreshold)
+            yield top, band
+    write_ppm(path, source.size, whitened())
+    return path
@@ -0,0 +1,133 @@
+# Finding the empty areas of a page that are big enough for a figure.
+#
+# maximal_empty_rectangles finds every rectangle within some bounds
+# that overlaps none of a set of obstacles, the page's lines of text,
+# and that can't be made any bigger in any direction without doing so.
+#
+# It sweeps down the page through the horizontal slabs between
+# consecutive obstacle tops and bottoms.  In each slab the free space is
+# a list of intervals of columns.  An open rectangle is an interval of
+# columns that has been free in every slab since its top.  At each slab
+# every open rectangle is narrowed to its intersections with the slab's
+# free intervals, and each free interval also opens a rectangle of its
+# own.  A rectangle is complete when its columns are no longer all free
+# in the next slab.  Of the open rectangles with the same columns only
+# the one with the highest top is kept.  Rectangles narrower than the
+# minimum width are dropped as soon as they are found, since they can
+# only get narrower.
+
+from region import Region
+
+
+def free_intervals(left, right, blocked):
+    '''free_intervals returns the intervals from left up to right not
+    covered by any of the (left, right) intervals in blocked.'''
+    free = []
+    x = left
+    for l, r in sorted(blocked):
+        if l > x:
+            free.append((x, l))
+        x = max(x, r)
+    if x < right:
+        free.append((x, right))
+    return free
+
+
+def maximal_empty_rectangles(bounds, obstacles, min_width=1, min_height=1,
+                             max_aspect=None):
+    '''maximal_empty_rectangles returns, as Regions, the maximal rectangles
+    within the Region bounds that intersect none of the Regions in
+    obstacles, are at least min_width wide and min_height high and, if
+    max_aspect is given, whose longer side is no more than max_aspect
+    times their shorter.'''
+    # The obstacles' column intervals, keyed by the rows they start and
+    # end on.
+    starting = {}
+    ending = {}
+    for r in obstacles:
+        left = max(r.left, bounds.left)
+        right = min(r.right, bounds.right)
+        top = max(r.top, bounds.top)
+        bottom = min(r.bottom, bounds.bottom)
+        if left < right and top < bottom:
+            starting.setdefault(top, []).append((left, right))
+            ending.setdefault(bottom, []).append((left, right))
+    ys = sorted(set([bounds.top, bounds.bottom]) | set(starting) | set(ending))
+    found = []
+    def emit(left, right, top, bottom):
+        width = right - left
+        height = bottom - top
+        if width < min_width or height < min_height:
+            return
+        if max_aspect != None and max(width, height) > max_aspect * min(width, height):
+            return
+        found.append(Region(left, right, top, bottom))
+    # The obstacles in the current slab, and how many of each.
+    active = {}
+    # The top of each open rectangle, keyed by its (left, right).
+    open_rects = {}
+    for y, next_y in zip(ys, ys[1:]):
+        for interval in ending.get(y, ()):
+            active[interval] -= 1
+            if active[interval] == 0:
+                del active[interval]
+        for interval in starting.get(y, ()):
+            active[interval] = active.get(interval, 0) + 1
+        free = [f for f in free_intervals(bounds.left, bounds.right, active.keys())
+                if f[1] - f[0] >= min_width]
+        narrowed = {}
+        def keep(columns, top):
+            if top < narrowed.get(columns, next_y):
+                narrowed[columns] = top
+        for (left, right), top in open_rects.items():
+            still_open = False
+            for l, r in free:
+                l = max(l, left)
+                r = min(r, right)
+                if r - l < min_width:
+                    continue
+                if (l, r) == (left, right):
+                    still_open = True
+                keep((l, r), top)
+            if not still_open:
+                emit(left, right, top, y)
+        for columns in free:
+            keep(columns, y)
+        open_rects = narrowed
+    for (left, right), top in open_rects.items():
+        emit(left, right, top, bounds.bottom)
+    found.sort(key=lambda r: (r.top, r.left, r.bottom, r.right))
+    return found
+
+
+def figure_bounds(p):
+    '''figure_bounds returns the Region of the Page p in which to look for
+    figures: the page image less a quarter inch margin.'''
+    bounds = p.jp2_region
+    if p.metadata:
+        s = int(round(p.metadata.dpi * 0.25))
+        bounds = bounds.inset(s, s, s, s)
+    return bounds
+
+
+def page_image_regions(p, max_aspect=None):
+    '''page_image_regions returns the maximal empty rectangles of the Page
+    p, with its lines of text as obstacles, that are at least a quarter
+    of the width and a tenth of the height of its figure_bounds.  The
+    line boxes come from the book's OCRGeometry.'''
+    bounds = figure_bounds(p)
+    geometry = p.book.geometry
+    if p.sequence_number not in geometry.page_index:
+        return [bounds]
+    lines = [r for r in geometry.line_bounds(p.sequence_number, p.jp2_region)
+             if r.width > 0 and r.height > 0]
+    return maximal_empty_rectangles(bounds, lines,
+                                    bounds.width / 4, bounds.height / 10,
+                                    max_aspect)
+
+
+def book_image_regions(book, max_aspect=None):
+    '''book_image_regions returns a dict mapping the sequence number of
+    each page of book to its page_image_regions.'''
+    return dict([(p.sequence_number, page_image_regions(p, max_aspect))
+                 for p in book.pages])